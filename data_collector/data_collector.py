@@ -1,11 +1,14 @@
 #!/usr/local/bin/python
 from firebase_admin import credentials, firestore, initialize_app
+from requests import Session
 from requests import get as api_get
 from time import time as timestamp
 from time import sleep as wait
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 
+from stats_core import RunningStats
+
 
 class DataCollector:
     '''
@@ -21,11 +24,26 @@ class DataCollector:
     __API_ENDPOINT = "api.openweathermap.org/data/2.5/weather"
     __NODE_T_ENDPOINT = "http://ss.maxhunt.design:3333/temp"
     __NODE_H_ENDPOINT = "http://ss.maxhunt.design:3333/hmdt"
+    __NODE_LOG_ENDPOINT = "http://ss.maxhunt.design:3333/log"
+    __BACKFILL_WINDOW = 60*30  # Seconds between a node reading and its doc
     __TESTING = False
+    __STATS_COLLECTION = "weather_stats"  # One document per site
+    __STATS_COLUMNS = ['humidity', 'local_soil_temperature',
+                       'temp', 'cloud', 'wind', 'rain_1h']
+    __SENTINEL = -50  # Value recorded when a node read fails
+    __DAILY_COLLECTION = "weather_daily"  # One document per day
+    __SUMMARY_COLLECTION = "weather_summary"
+    __SUMMARY_DOC = "last_24h"
+    __SUMMARY_SIZE = 24  # Readings kept in the rolling summary
+    __SUMMARY_SPAN = 60*60*24  # Older readings are dropped from the summary
+    __ROLLUP_COLUMNS = __STATS_COLUMNS + ['local_soil_humidity']
+    __SCHEMA_VERSION = 2  # No datetime field, failed reads are omitted
 
     def __init__(self):
         self.init_firebase()
         self.init_api()
+        self.last_written = self.load_last_written()
+        self.last_log_seq = 0  # Latest satellite reading forwarded
 
     def init_firebase(self):
         '''
@@ -45,9 +63,44 @@ class DataCollector:
         self.request_url = (f"https://{self.__API_ENDPOINT}?"
                             f"q={self.__CITY} &"
                             f"appid={str(self.api_key)}".split('\n')[0])
+        self.session = Session()  # Keeps the connection alive between calls
+        self.cached_rsp = None
+
+    def load_last_written(self):
+        '''
+        Loads the latest uploaded reading from the rolling summary,
+        so a restart does not upload the same observation twice
+        '''
+        try:
+            snapshot = self.firestore_db.collection(
+                self.__SUMMARY_COLLECTION).document(self.__SUMMARY_DOC).get()
+            if not snapshot.exists:
+                return None
+            readings = snapshot.to_dict().get('readings', [])
+            return readings[-1] if readings else None
+        except Exception as e:
+            logging.warning(f"Could not load the last reading: {e}")
+            return None
 
     def get_weather_data(self):
-        api_rsp = api_get(self.request_url)
+        '''
+        Queries the API conditionally, reusing the cached response
+        if the server reports that it has not changed
+        '''
+        headers = {}
+        if self.cached_rsp is not None:
+            etag = self.cached_rsp.headers.get('ETag')
+            last_modified = self.cached_rsp.headers.get('Last-Modified')
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        api_rsp = self.session.get(self.request_url, headers=headers)
+        if api_rsp.status_code == 304:
+            logging.info("Weather data not modified, using cached response")
+            return self.cached_rsp
+        if api_rsp.status_code == 200:
+            self.cached_rsp = api_rsp
         return api_rsp
 
     def process_api_data(self, api_rsp):
@@ -56,23 +109,23 @@ class DataCollector:
             logging.error("Big problem, "
                           f"expected 200 but got {api_data.status_code}")
             logging.error(f"Response: {api_data.text}")
-            return {"data": None}
+            return None
 
         try:  # Try to get the local sensor data
             rsp = api_get(self.__NODE_H_ENDPOINT)
             rsp_json = rsp.json()
-            local_hmdt = rsp_json.get('value', False)
+            local_hmdt = rsp_json.get('value')
         except Exception as e:
             logging.error(f'Failed to get data from humidity node!!!, {e}')
-            local_hmdt = -50  # Make it an obviously false value
+            local_hmdt = None  # Left out of the document
 
         try:  # Try to get the local sensor data
             rsp = api_get(self.__NODE_T_ENDPOINT)
             rsp_json = rsp.json()
-            local_temp = rsp_json.get('value', False)
+            local_temp = rsp_json.get('value')
         except Exception as e:
             logging.error(f'Failed to get data from local temp node!!!, {e}')
-            local_temp = -50  # Make it an obviously false value
+            local_temp = None  # Left out of the document
 
         weather_data = api_data.json()
         station_data = weather_data.get('main', False)
@@ -88,44 +141,315 @@ class DataCollector:
             rain_mm_1h = rain_data.get('1h', 0)
 
             relevant_data = {  # turn it into a dict for easy handling
+                "schema": self.__SCHEMA_VERSION,
                 "timestamp": timestamp(),
-                "datetime": datetime.now(),
+                # Time of the observation, repeats if the API has no news
+                "observed": weather_data.get('dt', int(timestamp())),
                 "temp": current_temp_celcius,
                 "humidity": current_humidity_pct,
                 "cloud": current_cloud_pct,
                 "wind": current_wind_ms,
-                "rain_1h": rain_mm_1h,
-                "local_soil_humidity": local_hmdt,
-                "local_soil_temperature": local_temp,
-                "is_test": self.__TESTING
+                "rain_1h": rain_mm_1h
             }
+            if self.is_valid_value(local_hmdt):
+                relevant_data["local_soil_humidity"] = local_hmdt
+            if self.is_valid_value(local_temp):
+                relevant_data["local_soil_temperature"] = local_temp
+            if self.__TESTING:
+                relevant_data["is_test"] = True
             return relevant_data
         else:
             logging.warning("COULD NOT GET STATION DATA")
-            relevant_data = {
-                "timestamp": timestamp(),
-                "datetime": datetime.now()
-            }
-            return relevant_data
+            return None
+
+    def is_new_observation(self, data: dict):
+        '''
+        Checks whether the API observation has not been written yet
+        '''
+        if self.last_written is None:
+            return True
+        return data['observed'] != self.last_written.get('observed')
+
+    def is_duplicate(self, data: dict):
+        '''
+        Checks whether merging the reading into the last written one
+        would change nothing apart from the time it was collected at
+        '''
+        if self.last_written is None:
+            return False
+        ignored = ['timestamp']
+        return all(self.last_written.get(k) == v
+                   for k, v in data.items() if k not in ignored)
+
+    def load_reading(self, observed: int):
+        '''
+        Loads the stored document of an observation, None if there is none
+        '''
+        snapshot = self.firestore_db.collection(u'weather_data').document(
+            str(observed)).get()
+        return snapshot.to_dict() if snapshot.exists else None
 
     def upload_to_firebase(self, data: dict):
         '''
-        Upload the processed data to the cloud database
+        Upload the processed data to the cloud database, keyed by the
+        observation time so a repeated observation merges into its document.
+        updated records the write, consumers sync on it to see edits
         '''
         try:
-            self.firestore_db.collection(u'weather_data').add(data)
+            self.firestore_db.collection(u'weather_data').document(
+                str(data['observed'])).set(
+                    dict(data, updated=timestamp()), merge=True)
         except Exception as e:
             logging.error(f"FAILED TO UPLOAD TO FIREBASE: {e}")
 
+    def is_valid_value(self, value):
+        '''
+        Filters out missing readings and failed node sentinels
+        '''
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return False
+        return value != self.__SENTINEL
+
+    def update_stats(self, data: dict, previous: dict = None):
+        '''
+        Folds the reading into the site's running normalisation statistics,
+        costs one document read and write regardless of the history length.
+        When a stored reading is merged into, previous is the stored version
+        and the values that changed are swapped out
+        '''
+        if data.get('is_test'):  # Test readings are skipped
+            return
+        stats_ref = self.firestore_db.collection(
+            self.__STATS_COLLECTION).document(self.__CITY)
+
+        @firestore.transactional
+        def fold_reading(transaction, ref):
+            snapshot = ref.get(transaction=transaction)
+            stored = snapshot.to_dict() if snapshot.exists else {}
+            columns = stored.get('columns', {})
+            for column in self.__STATS_COLUMNS:
+                value = data.get(column)
+                old_value = (previous or {}).get(column)
+                if value == old_value:
+                    continue
+                stats = RunningStats.from_dict(columns.get(column, {}))
+                if self.is_valid_value(old_value):
+                    stats.remove(old_value)
+                if self.is_valid_value(value):
+                    stats.update(value)
+                columns[column] = stats.to_dict()
+            transaction.set(ref, {
+                "site": self.__CITY,
+                "columns": columns,
+                "updated": timestamp()
+            })
+
+        try:
+            fold_reading(self.firestore_db.transaction(), stats_ref)
+        except Exception as e:
+            logging.error(f"FAILED TO UPDATE STATISTICS: {e}")
+
+    def fold_into_rollup(self, columns: dict, data: dict):
+        '''
+        Adds a reading to the per-column count, sum, mean, min and max
+        '''
+        for column in self.__ROLLUP_COLUMNS:
+            value = data.get(column)
+            if not self.is_valid_value(value):
+                continue
+            rollup = columns.get(column)
+            if rollup is None:
+                rollup = {"count": 0, "sum": 0, "min": value, "max": value}
+            rollup["count"] += 1
+            rollup["sum"] += value
+            rollup["mean"] = rollup["sum"] / rollup["count"]
+            rollup["min"] = min(rollup["min"], value)
+            rollup["max"] = max(rollup["max"], value)
+            columns[column] = rollup
+        return columns
+
+    def daily_rollup(self, day: str, columns: dict, updated: float):
+        return {
+            "date": day,
+            "columns": columns,
+            "rain_total": columns.get('rain_1h', {}).get('sum', 0),
+            "updated": updated
+        }
+
+    def summary_rollup(self, readings: list, updated: float):
+        columns = {}
+        for reading in readings:
+            self.fold_into_rollup(columns, reading)
+        return {
+            "readings": readings,  # oldest first
+            "columns": columns,
+            "rain_24h": columns.get('rain_1h', {}).get('sum', 0),
+            "updated": updated
+        }
+
+    def day_of(self, reading_time: float):
+        return datetime.fromtimestamp(reading_time).strftime('%Y-%m-%d')
+
+    def update_rollups(self, data: dict):
+        '''
+        Keeps the daily aggregate and the rolling last 24h summary up to date,
+        so consumers can read one document instead of the raw readings
+        '''
+        if data.get('is_test'):  # Test readings are skipped
+            return
+        day = self.day_of(data['timestamp'])
+        daily_ref = self.firestore_db.collection(
+            self.__DAILY_COLLECTION).document(day)
+        summary_ref = self.firestore_db.collection(
+            self.__SUMMARY_COLLECTION).document(self.__SUMMARY_DOC)
+
+        @firestore.transactional
+        def fold_reading(transaction, daily_ref, summary_ref):
+            # Firestore transactions need all reads before any writes
+            daily_snapshot = daily_ref.get(transaction=transaction)
+            summary_snapshot = summary_ref.get(transaction=transaction)
+            daily = daily_snapshot.to_dict() if daily_snapshot.exists else {}
+            summary = (summary_snapshot.to_dict()
+                       if summary_snapshot.exists else {})
+
+            daily_columns = self.fold_into_rollup(
+                daily.get('columns', {}), data)
+            transaction.set(daily_ref, self.daily_rollup(
+                day, daily_columns, data['timestamp']))
+
+            # After an outage the previous readings can be days old
+            oldest = data['timestamp'] - self.__SUMMARY_SPAN
+            readings = [reading for reading in summary.get('readings', [])
+                        if reading['timestamp'] >= oldest] + [data]
+            readings = readings[-self.__SUMMARY_SIZE:]
+            transaction.set(summary_ref, self.summary_rollup(
+                readings, data['timestamp']))
+
+        try:
+            fold_reading(self.firestore_db.transaction(),
+                         daily_ref, summary_ref)
+        except Exception as e:
+            logging.error(f"FAILED TO UPDATE ROLLUPS: {e}")
+
+    def rebuild_rollups(self, reading_times):
+        '''
+        Recomputes the daily aggregates of the given reading times and the
+        rolling summary from the stored readings. Only needed when readings
+        that were already folded in change, so the extra reads are rare
+        '''
+        readings_ref = self.firestore_db.collection(u'weather_data')
+        now = timestamp()
+        try:
+            for day in {self.day_of(t) for t in reading_times}:
+                start = datetime.strptime(day, '%Y-%m-%d')
+                query = readings_ref.where(
+                    'timestamp', '>=', start.timestamp()).where(
+                    'timestamp', '<', (start + timedelta(days=1)).timestamp())
+                columns = {}
+                for doc in query.stream():
+                    if not doc.to_dict().get('is_test'):
+                        self.fold_into_rollup(columns, doc.to_dict())
+                self.firestore_db.collection(self.__DAILY_COLLECTION).document(
+                    day).set(self.daily_rollup(day, columns, now))
+
+            query = readings_ref.where(
+                'timestamp', '>=', now - self.__SUMMARY_SPAN).order_by(
+                'timestamp', direction=firestore.Query.DESCENDING).limit(
+                self.__SUMMARY_SIZE)
+            readings = [doc.to_dict() for doc in query.stream()]
+            readings = [reading for reading in reversed(readings)
+                        if not reading.get('is_test')]
+            # Bumping updated lets the predictor see the data changed
+            self.firestore_db.collection(self.__SUMMARY_COLLECTION).document(
+                self.__SUMMARY_DOC).set(self.summary_rollup(readings, now))
+        except Exception as e:
+            logging.error(f"FAILED TO REBUILD ROLLUPS: {e}")
+
+    def backfill_reading(self, reading: dict):
+        '''
+        Fills in the soil values of the document closest to a buffered
+        node reading, if they could not be polled at the time, and folds
+        them into the statistics. Returns the filled document's timestamp
+        so its rollups can be rebuilt, None if nothing was filled
+        '''
+        values = {}
+        if self.is_valid_value(reading.get('temp')):
+            values["local_soil_temperature"] = reading['temp']
+        if self.is_valid_value(reading.get('hmdt')):
+            values["local_soil_humidity"] = reading['hmdt']
+        if not values:
+            return None
+        reading_time = reading['timestamp']
+        query = self.firestore_db.collection(u'weather_data').where(
+            'timestamp', '>=', reading_time - self.__BACKFILL_WINDOW).where(
+            'timestamp', '<=', reading_time + self.__BACKFILL_WINDOW).limit(1)
+        for doc in query.stream():
+            stored = doc.to_dict()
+            if "local_soil_temperature" in stored:
+                return None  # The node was polled, nothing to fill
+            doc.reference.set(dict(values, updated=timestamp()), merge=True)
+            self.update_stats(dict(stored, **values), stored)
+            return stored['timestamp']
+        return None
+
+    def backfill_from_node(self):
+        '''
+        Fetches the readings the satellite buffered since the last call,
+        through the master node, and fills the gaps they cover
+        '''
+        try:
+            rsp = api_get(self.__NODE_LOG_ENDPOINT,
+                          params={'since': self.last_log_seq})
+            readings = rsp.json().get('value', [])
+        except Exception as e:
+            logging.error(f'Failed to get the node backlog!!!, {e}')
+            return
+        filled = []  # Timestamps of the filled documents
+        for reading in readings:
+            try:
+                reading_time = self.backfill_reading(reading)
+            except Exception as e:
+                logging.error(f"FAILED TO BACKFILL: {e}")
+                break  # Retry from this reading next time
+            if reading_time is not None:
+                filled.append(reading_time)
+            self.last_log_seq = max(self.last_log_seq, reading['seq'])
+        if filled:  # One rebuild for the whole backlog
+            self.rebuild_rollups(filled)
+        logging.info(f"Got {len(readings)} buffered node readings, "
+                     f"filled {len(filled)} gaps")
+
     def collect_data(self):
         '''
         Main data collection process
         '''
         try:
             logging.info(f"Running collection at {datetime.now()}")
+            self.backfill_from_node()  # Fill gaps from previous outages
             weather_data = self.get_weather_data()
             processed_data = self.process_api_data(weather_data)
+            if not processed_data:
+                return
+            if self.is_duplicate(processed_data):
+                logging.info("Nothing changed since the last upload")
+                return
+            previous = None
+            if not self.is_new_observation(processed_data):
+                previous = self.load_reading(processed_data['observed'])
             self.upload_to_firebase(processed_data)
+            if previous is None:
+                self.update_stats(processed_data)
+                self.update_rollups(processed_data)
+                self.last_written = processed_data
+                return
+            # The observation was already counted, the merge may have
+            # changed its values and moved it to a later collection time
+            merged = dict(previous, **processed_data)
+            self.update_stats(merged, previous)
+            if not merged.get('is_test'):
+                self.rebuild_rollups(
+                    [previous['timestamp'], merged['timestamp']])
+            self.last_written = merged
         except Exception as e:
             logging.error(f"ERROR: {e}")
 
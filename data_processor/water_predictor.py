@@ -1,20 +1,102 @@
 #!/usr/local/bin/python
+import gzip
+import hashlib
+import json
 import logging
+import os
+import sqlite3
+import threading
+import time
 
 import firebase_admin
 import numpy as np
 import pandas as pd
 from firebase_admin import credentials, firestore
-from flask import Flask
+from flask import Flask, make_response, request
+from stats_core import RunningStats
 from tensorflow import keras
 
 
+class LocalCache:
+    '''
+    On-disk SQLite copy of the recent readings, holding only the
+    columns the DataProcessor needs
+    '''
+    __DB_PATH = 'cache/weather_cache.sqlite'
+    __VERSION = 2  # Bumped when the columns change, drops the old table
+    COLUMNS = ['timestamp', 'updated', 'humidity', 'local_soil_temperature',
+               'temp', 'cloud', 'wind', 'rain_1h']
+
+    def __init__(self, path: str = __DB_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Flask serves requests from several threads
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        columns = ', '.join(f'{column} REAL' for column in self.COLUMNS)
+        with self.lock, self.db:
+            version, = self.db.execute('PRAGMA user_version').fetchone()
+            if version != self.__VERSION:
+                self.db.execute('DROP TABLE IF EXISTS readings')
+                self.db.execute(f'PRAGMA user_version = {self.__VERSION}')
+            self.db.execute('CREATE TABLE IF NOT EXISTS readings '
+                            f'(id TEXT PRIMARY KEY, {columns})')
+            self.db.execute('CREATE INDEX IF NOT EXISTS readings_timestamp '
+                            'ON readings (timestamp)')
+        logging.debug(f'Opened local cache at {path}')
+
+    def last_seen(self):
+        '''
+        Returns when the newest cached reading was written, documents
+        from before updated existed fall back to their timestamp
+        '''
+        with self.lock:
+            row = self.db.execute(
+                'SELECT MAX(COALESCE(updated, timestamp)) '
+                'FROM readings').fetchone()
+        return row[0]
+
+    def store(self, docs):
+        '''
+        Inserts or replaces the given firestore documents
+        '''
+        rows = []
+        for doc in docs:
+            data = doc.to_dict()
+            rows.append([doc.id] + [data.get(column)
+                                    for column in self.COLUMNS])
+        placeholders = ', '.join('?' * (len(self.COLUMNS) + 1))
+        with self.lock, self.db:
+            self.db.executemany(
+                f'INSERT OR REPLACE INTO readings VALUES ({placeholders})',
+                rows)
+        return len(rows)
+
+    def evict(self, oldest: float):
+        '''
+        Deletes the readings older than the retention window
+        '''
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM readings WHERE timestamp < ?',
+                            (oldest,))
+
+    def latest(self, last_n: int = 24):
+        '''
+        Returns the latest readings as a dataFrame, newest first
+        '''
+        with self.lock:
+            rows = self.db.execute(
+                f'SELECT {", ".join(self.COLUMNS)} FROM readings '
+                'ORDER BY timestamp DESC LIMIT ?', (last_n,)).fetchall()
+        return pd.DataFrame(rows, columns=self.COLUMNS, dtype=float)
+
+
 class Firebase:
     '''
     This class is responsible for querying the data from
     the cloud database
     '''
     __CERT_PATH = "secrets/icl-iot-weather-firebase-adminsdk.json"
+    __CACHE_RETENTION = 60*60*48  # Seconds of readings kept locally
 
     def __init__(self):
         '''
@@ -23,6 +105,8 @@ class Firebase:
         self.creds = credentials.Certificate(self.__CERT_PATH)
         firebase_admin.initialize_app(self.creds)
         self.db = firestore.client()
+        self.cache = LocalCache()
+        self.sync_lock = threading.Lock()  # One download at a time
         logging.debug('Initialized firebase instance')
 
     def pull_from_db(self, last_n: int = 24, orderby: str = u'timestamp'):
@@ -38,6 +122,67 @@ class Firebase:
         logging.debug('Got doc file from firestore')
         return doc
 
+    def pull_new(self, since: float, fields: list, field: str = 'updated'):
+        '''
+        Pulls only the given fields of the readings written or edited
+        after since
+        '''
+        doc_ref = self.db.collection('weather_data')
+        query = doc_ref.where(field, '>', since).order_by(field).select(fields)
+        return query.stream()
+
+    def sync_cache(self):
+        '''
+        Downloads the readings added or edited since the last sync into
+        the local cache and evicts the ones past the retention window
+        '''
+        with self.sync_lock:
+            oldest = time.time() - self.__CACHE_RETENTION
+            since = self.cache.last_seen()
+            if since is None:  # Older documents have no updated field
+                docs = self.pull_new(oldest, LocalCache.COLUMNS, 'timestamp')
+            else:
+                docs = self.pull_new(since, LocalCache.COLUMNS)
+            downloaded = self.cache.store(docs)
+            self.cache.evict(oldest)
+        logging.debug(f'Synced local cache, {downloaded} new readings')
+
+    def pull_stats(self):
+        '''
+        Pulls the running statistics of every site and merges them
+        into one state per column
+        '''
+        merged = {}
+        for site in self.db.collection('weather_stats').stream():
+            columns = site.to_dict().get('columns', {})
+            for column, state in columns.items():
+                stats = merged.get(column, RunningStats())
+                merged[column] = stats.merge(RunningStats.from_dict(state))
+        logging.debug(f'Merged running stats for {len(merged)} columns')
+        return merged
+
+    def pull_last_update(self):
+        '''
+        Returns when the readings last changed, taken from the
+        summary document so it costs a single read
+        '''
+        snapshot = self.db.collection(
+            'weather_summary').document('last_24h').get()
+        if not snapshot.exists:
+            return None
+        return snapshot.to_dict().get('updated')
+
+    def pull_range(self, start: float, end: float, fields: list):
+        '''
+        Pulls the readings between start and end, oldest first,
+        downloading only the timestamp and the requested fields
+        '''
+        doc_ref = self.db.collection('weather_data')
+        query = doc_ref.where('timestamp', '>=', start).where(
+            'timestamp', '<=', end).order_by('timestamp').select(
+                ['timestamp'] + fields)
+        return query.stream()
+
     def convert_to_df(self, data):
         '''
         converts the provided firebase colelction into a dataFrame
@@ -52,7 +197,32 @@ class Firebase:
         logging.debug(f'Acquired dataframe, length: {len(df)}')
         return df
 
+    def pull_summary(self):
+        '''
+        Pulls the rolling last 24h summary kept up to date by the collector,
+        returns an empty list if it does not exist yet
+        '''
+        snapshot = self.db.collection(
+            'weather_summary').document('last_24h').get()
+        if not snapshot.exists:
+            return []
+        logging.debug('Got summary doc from firestore')
+        return snapshot.to_dict().get('readings', [])
+
     def get_day_df(self):
+        try:  # Only the readings added since the last call are downloaded
+            self.sync_cache()
+            df = self.cache.latest()
+            if not df.empty:
+                logging.debug(f'Acquired dataframe, length: {len(df)}')
+                return df
+        except Exception as e:
+            logging.error(f'Local cache failed, using firestore: {e}')
+        readings = self.pull_summary()  # One read instead of 24
+        if readings:
+            df = pd.DataFrame(readings)
+            logging.debug(f'Acquired dataframe, length: {len(df)}')
+            return df
         doc = self.pull_from_db()
         df = self.convert_to_df(doc)
         return df
@@ -63,6 +233,8 @@ class DataProcessor:
     This class is responsible for normalizing the data and
     preparing it to be passed into the ML model for a prediction
     '''
+    # Training statistics are saved next to the model they belong to
+    __STATS_PATH = 'watering_model.model/normalization.json'
 
     def __init__(self):
         self.dataset_mean = [82.02044198895028, 10.402061304914362,
@@ -77,16 +249,69 @@ class DataProcessor:
         # Relative to the entire dataset, the dataset mean and std
         # are virtually constant, the model was trained using this
         # normalization so all data must be normalized this way
+        self.training_stats = self.load_training_stats()
+        if self.training_stats:
+            self.dataset_mean = [self.training_stats[column].mean
+                                 for column in self.arranged_columns]
+            self.dataset_std = [self.training_stats[column].std
+                                for column in self.arranged_columns]
+
+    def load_training_stats(self):
+        '''
+        Loads the normalization statistics persisted with the model,
+        returns an empty dict if the model has none
+        '''
+        if not os.path.exists(self.__STATS_PATH):
+            logging.warning('No saved normalization stats, using defaults')
+            return {}
+        with open(self.__STATS_PATH, 'r') as stats_file:
+            columns = json.load(stats_file).get('columns', {})
+        return {column: RunningStats.from_dict(state)
+                for column, state in columns.items()}
+
+    def drift(self, live_stats: dict):
+        '''
+        Compares the live statistics to the ones the model was trained on,
+        the mean shift is expressed in training standard deviations
+        '''
+        report = {}
+        for column, mean, std in zip(self.arranged_columns,
+                                     self.dataset_mean, self.dataset_std):
+            live = live_stats.get(column)
+            if not live or not live.count:
+                continue
+            report[column] = {
+                'count': live.count,
+                'mean_shift': (live.mean - mean)/std,
+                'std_ratio': live.std/std
+            }
+        return report
 
     def drop_useless(self, df):
         '''
-        Deletes the useless columns
+        Deletes the useless columns, not every schema version has all of them
         '''
         clean_df = df.drop(
-            columns=['datetime', 'is_test',
-                     'local_soil_humidity', 'timestamp'])
+            columns=['datetime', 'is_test', 'local_soil_humidity',
+                     'timestamp', 'observed', 'schema', 'updated'],
+            errors='ignore')
         return clean_df
 
+    def fill_missing(self, df):
+        '''
+        Arranges the columns, schema 2 readings leave out failed soil reads
+        so a column can be missing or empty, it then takes its training mean
+        '''
+        if df.empty:
+            raise ValueError('No readings to predict from')
+        df = df.reindex(columns=self.arranged_columns)
+        for column, mean in zip(self.arranged_columns, self.dataset_mean):
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+            if df[column].isna().all():
+                logging.warning(f'No {column} readings, using training mean')
+                df[column] = mean
+        return df
+
     def normalize(self, df):
         '''
         Normalizes the dataset to avoid the NaN trap
@@ -126,12 +351,158 @@ class DataProcessor:
         Runs all necessary subroutines to prepare data for
         prediction by the model
         '''
-        clean_df = self.drop_useless(data)
+        clean_df = self.fill_missing(self.drop_useless(data))
         normalized_df = self.normalize(clean_df)
         corrected_df = self.correct(normalized_df, clean_df)
         daily_avg_df = self.calculate_avg(corrected_df)
         return daily_avg_df
 
+    def persistence_forecast(self, data):
+        '''
+        Local forecast stand-in, assumes tomorrow's conditions will be
+        today's daily averages and rainfall in physical units
+        '''
+        clean_df = self.fill_missing(self.drop_useless(data))
+        day_avg = clean_df.drop(columns=['rain_1h']).mean().to_dict()
+        day_avg['rain_24h'] = clean_df['rain_1h'].sum()
+        return day_avg
+
+    def prepare_scenarios(self, grid: dict):
+        '''
+        Builds one feature row for every combination of the grid values,
+        the grid holds daily averages in physical units and rain_24h in mm.
+        Normalization is linear so it matches prepare_for_prediction
+        '''
+        columns = list(grid.keys())
+        axes = [np.asarray(grid[column], dtype=float) for column in columns]
+        mesh = np.meshgrid(*axes, indexing='ij')
+        features = {}
+        for column, values in zip(columns, mesh):
+            values = values.ravel()
+            if column == 'cloud':
+                values = values/100 - 0.5
+            elif column in self.arranged_columns:
+                index = self.arranged_columns.index(column)
+                values = ((values - self.dataset_mean[index])
+                          / self.dataset_std[index])
+            features[column] = values  # rain_24h is not normalized
+        shape = [len(axis) for axis in axes]
+        return features, shape
+
+
+class TimeSeries:
+    '''
+    This class serves downsampled, columnar ranges of the collected data
+    for the monitoring website
+    '''
+    __FIELDS = ['temp', 'humidity', 'cloud', 'wind', 'rain_1h',
+                'local_soil_humidity', 'local_soil_temperature']
+    __METHODS = ['lttb', 'minmax']
+    __DEFAULT_SPAN = 60*60*24*10  # Ten days, same as the old 240 readings
+    __MAX_SPAN = 60*60*24*90  # Bounds the number of documents read
+    __DEFAULT_POINTS = 240
+    __MAX_POINTS = 5000
+
+    def __init__(self, firebase: Firebase):
+        self.firebase = firebase
+
+    def parse_query(self, args):
+        '''
+        Validates the request arguments, raises ValueError if they are wrong
+        '''
+        fields = args.get('fields', ','.join(self.__FIELDS)).split(',')
+        unknown = [field for field in fields if field not in self.__FIELDS]
+        if unknown:
+            raise ValueError(f'Unknown fields: {unknown}')
+        method = args.get('method', 'lttb')
+        if method not in self.__METHODS:
+            raise ValueError(f'Unknown method: {method}')
+        points = int(args.get('points', self.__DEFAULT_POINTS))
+        if not 2 < points <= self.__MAX_POINTS:
+            raise ValueError(f'points must be in 3..{self.__MAX_POINTS}')
+        start = args.get('start')
+        end = args.get('end')
+        return {
+            'fields': fields,
+            'method': method,
+            'points': points,
+            'start': float(start) if start else None,
+            'end': float(end) if end else None
+        }
+
+    def get_etag(self, query: dict, last_update: float):
+        '''
+        The response only changes when new data arrives, so the tag is
+        derived from the query and the latest reading's timestamp
+        '''
+        key = json.dumps([query, last_update], sort_keys=True)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def lttb(self, x, y, threshold: int):
+        '''
+        Largest-Triangle-Three-Buckets downsampling, keeps the first and
+        last points and the visually most significant point of each bucket
+        '''
+        n = len(x)
+        if threshold >= n:
+            return x, y
+        every = (n - 2) / (threshold - 2)
+        sampled = [0]
+        a = 0
+        for i in range(threshold - 2):
+            range_start = int(i * every) + 1
+            range_end = int((i + 1) * every) + 1
+            avg_start = range_end
+            avg_end = min(int((i + 2) * every) + 1, n)
+            avg_x = x[avg_start:avg_end].mean()
+            avg_y = y[avg_start:avg_end].mean()
+            area = np.abs(
+                (x[a] - avg_x) * (y[range_start:range_end] - y[a])
+                - (x[a] - x[range_start:range_end]) * (avg_y - y[a]))
+            a = range_start + int(np.argmax(area))
+            sampled.append(a)
+        sampled.append(n - 1)
+        return x[sampled], y[sampled]
+
+    def min_max(self, x, y, threshold: int):
+        '''
+        Keeps the minimum and maximum of each bucket, in time order
+        '''
+        n = len(x)
+        if threshold >= n:
+            return x, y
+        sampled = []
+        for bucket in np.array_split(np.arange(n), threshold // 2):
+            low = bucket[np.argmin(y[bucket])]
+            high = bucket[np.argmax(y[bucket])]
+            sampled.extend(sorted({low, high}))
+        return x[sampled], y[sampled]
+
+    def get_series(self, query: dict, last_update: float):
+        '''
+        Pulls the requested range and downsamples every field to
+        the requested number of points
+        '''
+        end = query['end'] or last_update or time.time()
+        start = query['start'] or end - self.__DEFAULT_SPAN
+        start = max(start, end - self.__MAX_SPAN)
+        docs = self.firebase.pull_range(start, end, query['fields'])
+        df = self.firebase.convert_to_df(docs)
+        downsample = self.lttb if query['method'] == 'lttb' else self.min_max
+        series = {}
+        for field in query['fields']:
+            if df.empty or field not in df:
+                series[field] = {'timestamp': [], 'value': []}
+                continue
+            values = pd.to_numeric(df[field], errors='coerce')
+            valid = values.notna()
+            x = df['timestamp'][valid].to_numpy(dtype=float)
+            y = values[valid].to_numpy(dtype=float)
+            x, y = downsample(x, y, query['points'])
+            series[field] = {'timestamp': x.tolist(), 'value': y.tolist()}
+        return {'start': start, 'end': end, 'method': query['method'],
+                'series': series}
+
 
 class WaterPredictor:
     '''
@@ -142,6 +513,10 @@ class WaterPredictor:
     '''
     __PLANT_AREA_M2 = 1  # One square metre of plants
     __WATER_ML_PER_M2 = 500  # 1msq requires 500 ml daily in average conditions
+    __SCENARIO_COLUMNS = ['humidity', 'local_soil_temperature',
+                          'temp', 'cloud', 'wind', 'rain_24h']
+    __MAX_SCENARIOS = 100000  # Keeps a single batch within memory
+    __MAX_AXIS_VALUES = 100  # Per column, bounds the request parsing
 
     def __init__(self):
         self.firebase = Firebase()  # init the Firebase instance
@@ -184,13 +559,65 @@ class WaterPredictor:
         # convert to volume
         predicted_watering_vol = self.calculate_predicted_volume(offset_pct)
         logging.debug(f'Predicted watering volume: {predicted_watering_vol}')
-        return predicted_watering_vol
+        return float(predicted_watering_vol)  # numpy floats are not JSON
 
+    def parse_grid(self, args):
+        '''
+        Parses the request arguments into the scenario grid,
+        raises ValueError if they are wrong
+        '''
+        grid = {}
+        for column, values in args.items():
+            values = values.split(',', self.__MAX_AXIS_VALUES)
+            if len(values) > self.__MAX_AXIS_VALUES:
+                raise ValueError(f'More than {self.__MAX_AXIS_VALUES} '
+                                 f'values for {column}')
+            grid[column] = [float(value) for value in values]
+        return grid
 
-if __name__ == "__main__":
-    logging.root.setLevel(logging.DEBUG)
-    predictor = WaterPredictor()  # init the predictir class, and all children
+    def predict_scenarios(self, grid: dict):
+        '''
+        Predicts the watering volume for every combination of the
+        hypothetical conditions in one batched model call.
+        Columns missing from the grid are taken from the local forecast
+        '''
+        unknown = [column for column in grid
+                   if column not in self.__SCENARIO_COLUMNS]
+        if unknown:
+            raise ValueError(f'Unknown scenario columns: {unknown}')
+        # Checked before the grid is built, missing columns add one value
+        n_scenarios = int(np.prod([len(values) for values in grid.values()]))
+        if n_scenarios > self.__MAX_SCENARIOS:
+            raise ValueError(f'{n_scenarios} scenarios requested, '
+                             f'the limit is {self.__MAX_SCENARIOS}')
+        missing = [column for column in self.__SCENARIO_COLUMNS
+                   if column not in grid]
+        if missing:
+            forecast = self.data_processor.persistence_forecast(
+                self.firebase.get_day_df())
+            grid = dict(grid, **{column: [forecast[column]]
+                                 for column in missing})
+        grid = {column: list(grid[column])
+                for column in self.__SCENARIO_COLUMNS}
+        features, shape = self.data_processor.prepare_scenarios(grid)
+        bias = self.model.predict(features, batch_size=n_scenarios)
+        offset_pct = np.clip(bias[:, 0]*100, -100, 100)
+        volumes = self.calculate_predicted_volume(offset_pct)
+        logging.debug(f'Predicted {n_scenarios} scenarios')
+        return grid, volumes.reshape(shape)
 
+    def check_drift(self):
+        '''
+        Reports how far the collected data has drifted from the training data
+        '''
+        live_stats = self.firebase.pull_stats()
+        return self.data_processor.drift(live_stats)
+
+
+def create_server(predictor: WaterPredictor):
+    '''
+    Builds the HTTP API in front of the predictor
+    '''
     server = Flask(__name__)  #  init a flask server
 
     @server.route("/")
@@ -204,7 +631,74 @@ if __name__ == "__main__":
             return {'success': True, 'value': vol}
         except Exception as e:
             logging.error(f'Encountered error: {e}')
-            return {'success': False, 'error': e}
+            return {'success': False, 'error': str(e)}
+
+    @server.route("/drift")  # compare live data to the training data
+    def get_drift():
+        try:
+            return {'success': True, 'value': predictor.check_drift()}
+        except Exception as e:
+            logging.error(f'Encountered error: {e}')
+            return {'success': False, 'error': str(e)}
+
+    @server.route("/scenarios")  # e.g. /scenarios?rain_24h=0,5,10
+    def get_scenarios():
+        try:
+            grid = predictor.parse_grid(request.args)
+            grid, volumes = predictor.predict_scenarios(grid)
+        except ValueError as e:
+            return {'success': False, 'error': str(e)}, 400
+        except Exception as e:
+            logging.error(f'Encountered error: {e}')
+            return {'success': False, 'error': str(e)}, 500
+        # JSON objects are not ordered, so the dimensions of volume
+        # are listed explicitly: volume[i][j]... follows dims
+        return {'success': True, 'value': {
+            'dims': list(grid.keys()),
+            'axes': [{'name': column, 'values': values}
+                     for column, values in grid.items()],
+            'volume': volumes.tolist()}}
+
+    time_series = TimeSeries(predictor.firebase)
+
+    @server.route("/series")  # downsampled data for the website
+    def get_series():
+        try:
+            query = time_series.parse_query(request.args)
+        except ValueError as e:
+            return {'success': False, 'error': str(e)}, 400
+        gzipped = 'gzip' in request.headers.get('Accept-Encoding', '')
+        try:
+            last_update = predictor.firebase.pull_last_update()
+            etag = time_series.get_etag(query, last_update)
+            if gzipped:  # Different bytes need a different tag
+                etag = f'{etag}-gzip'
+            if last_update and request.if_none_match.contains(etag):
+                return '', 304, {'ETag': f'"{etag}"'}
+            body = json.dumps(
+                {'success': True,
+                 'value': time_series.get_series(query, last_update)})
+        except Exception as e:
+            logging.error(f'Encountered error: {e}')
+            return {'success': False, 'error': str(e)}, 500
+        response = make_response(body)
+        response.mimetype = 'application/json'
+        if gzipped:
+            response.set_data(gzip.compress(response.get_data()))
+            response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'no-cache'
+        if last_update:  # Without a summary doc there is nothing to tag
+            response.set_etag(etag)
+        return response
+
+    return server
+
+
+if __name__ == "__main__":
+    logging.root.setLevel(logging.DEBUG)
+    predictor = WaterPredictor()  # init the predictir class, and all children
+    server = create_server(predictor)  # init a flask server
 
     # Start the server
     server.run(host='0.0.0.0', port='3535', use_reloader=False)
@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+'''
+Load tester for the HTTP services.
+
+Starts the master node or the predictor in-process against local fakes
+(a simulated radio, an in-memory Firestore and a stub model), drives it
+with a configurable number of concurrent clients and request mix, and
+reports throughput, latency percentiles and error rates.
+
+Examples:
+    python load_tester.py master --concurrency 8 --duration 30
+    python load_tester.py predictor --mix /water:5 /series:1 \
+        --save-baseline baselines/predictor.json
+    python load_tester.py predictor --compare baselines/predictor.json
+'''
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from requests import Session
+from werkzeug.serving import make_server
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+class SimulatedRadio:
+    '''
+    Stands in for adafruit_rfm69.RFM69. The channel is half duplex,
+    so only one exchange is on air at a time, replies take a random
+    round trip time and a share of them is lost
+    '''
+    frequency_mhz = 915.0
+    bitrate = 250000
+    frequency_deviation = 250000
+    encryption_key = None
+    rssi = -60
+    last_rssi = -60
+    latency = 0.6  # Seconds, typical satellite reply time
+    jitter = 0.1
+    loss = 0.0
+    replies = {
+        'ping': lambda _: 'OK',
+        'iot_g_temp': lambda _: f'{random.uniform(5, 15):.2f}',
+        'iot_g_hmdt': lambda _: str(random.randint(300, 1000)),
+        'iot_pmp_ctrl': lambda _: 'OK'
+    }
+
+    def __init__(self, *_, **__):
+        self.channel = threading.Lock()
+        self.pending = None
+
+    def send(self, data: bytes):
+        command, _, argument = data.decode().partition('|')
+        reply = self.replies.get(command)
+        self.pending = reply(argument) if reply else None
+
+    def receive(self, timeout: float = 0.5, **_):
+        with self.channel:
+            delay = max(0, random.gauss(self.latency, self.jitter))
+            if self.pending is None or random.random() < self.loss:
+                time.sleep(timeout)
+                return None
+            time.sleep(min(delay, timeout))
+            if delay > timeout:
+                return None
+            reply, self.pending = self.pending, None
+            return bytes(reply, 'utf-8')
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id: str, data: dict):
+        self.id = doc_id
+        self.exists = data is not None
+        self.data = data
+
+    def to_dict(self):
+        return dict(self.data) if self.exists else None
+
+
+class FakeQuery:
+    '''
+    Supports the subset of the Firestore query API the predictor uses
+    '''
+
+    def __init__(self, docs: dict, filters=(), order=None,
+                 descending=False, limit=None, fields=None):
+        self.docs = docs
+        self.filters = list(filters)
+        self.order = order
+        self.descending = descending
+        self.max_docs = limit
+        self.fields = fields
+
+    def copy(self, **changes):
+        state = {'filters': self.filters, 'order': self.order,
+                 'descending': self.descending, 'limit': self.max_docs,
+                 'fields': self.fields}
+        state.update(changes)
+        return FakeQuery(self.docs, **state)
+
+    def where(self, field: str, op: str, value):
+        compare = {
+            '>': lambda a: a > value, '>=': lambda a: a >= value,
+            '<': lambda a: a < value, '<=': lambda a: a <= value,
+            '==': lambda a: a == value
+        }[op]
+        return self.copy(filters=self.filters + [(field, compare)])
+
+    def order_by(self, field: str, direction: str = 'ASCENDING'):
+        return self.copy(order=field, descending=direction == 'DESCENDING')
+
+    def limit(self, count: int):
+        return self.copy(limit=count)
+
+    def select(self, fields: list):
+        return self.copy(fields=fields)
+
+    def stream(self):
+        docs = [(doc_id, data) for doc_id, data in self.docs.items()
+                if all(field in data and compare(data[field])
+                       for field, compare in self.filters)]
+        if self.order:
+            docs.sort(key=lambda doc: doc[1].get(self.order, 0),
+                      reverse=self.descending)
+        for doc_id, data in docs[:self.max_docs]:
+            if self.fields:
+                data = {k: v for k, v in data.items() if k in self.fields}
+            yield FakeSnapshot(doc_id, data)
+
+
+class FakeDocument:
+    def __init__(self, docs: dict, doc_id: str):
+        self.docs = docs
+        self.id = doc_id
+
+    def get(self, **_):
+        return FakeSnapshot(self.id, self.docs.get(self.id))
+
+    def set(self, data: dict, merge: bool = False):
+        if merge:
+            data = dict(self.docs.get(self.id, {}), **data)
+        self.docs[self.id] = dict(data)
+
+
+class FakeCollection(FakeQuery):
+    def document(self, doc_id: str):
+        return FakeDocument(self.docs, doc_id)
+
+
+class FakeFirestore:
+    '''
+    In-memory Firestore seeded with hourly readings
+    '''
+
+    def __init__(self, hours: int = 24*10):
+        self.collections = {}
+        now = time.time()
+        readings = self.collections.setdefault('weather_data', {})
+        for hour in range(hours):
+            observed = int(now - (hours - hour)*3600)
+            readings[str(observed)] = {
+                'schema': 2,
+                'timestamp': observed,
+                'observed': observed,
+                'updated': observed,
+                'temp': random.uniform(2, 15),
+                'humidity': random.uniform(60, 95),
+                'cloud': random.uniform(0, 100),
+                'wind': random.uniform(0, 8),
+                'rain_1h': random.choice([0, 0, 0, 0.2, 1.1]),
+                'local_soil_humidity': random.randint(300, 1000),
+                'local_soil_temperature': random.uniform(5, 12)
+            }
+        latest = sorted(readings.values(), key=lambda r: r['timestamp'])
+        self.collections['weather_summary'] = {'last_24h': {
+            'readings': latest[-24:],
+            'updated': latest[-1]['timestamp']
+        }}
+        self.collections['weather_stats'] = {}
+
+    def collection(self, name: str):
+        return FakeCollection(self.collections.setdefault(name, {}))
+
+
+class StubModel:
+    '''
+    Stands in for the keras model, scores a batch after a fixed delay
+    '''
+    latency = 0.02
+
+    def predict(self, features: dict, **_):
+        import numpy as np
+        rows = len(next(iter(features.values())))
+        time.sleep(self.latency)
+        rain = np.asarray(features.get('rain_24h', np.zeros(rows)))
+        return (np.tanh(-rain/10) + 0.1).reshape(rows, 1).astype('float32')
+
+
+def install_fakes(firestore_db: FakeFirestore, model: StubModel):
+    '''
+    Registers fake hardware, Firebase and TensorFlow modules so the
+    service scripts can be imported on any machine
+    '''
+    board = types.ModuleType('board')
+    board.__getattr__ = lambda name: name  # Pins are just their names
+    busio = types.ModuleType('busio')
+    busio.SPI = busio.I2C = lambda *_, **__: None
+    digitalio = types.ModuleType('digitalio')
+    digitalio.DigitalInOut = lambda *_: types.SimpleNamespace()
+    digitalio.Direction = types.SimpleNamespace(OUTPUT='output')
+    rfm69 = types.ModuleType('adafruit_rfm69')
+    rfm69.RFM69 = SimulatedRadio
+
+    firebase_admin = types.ModuleType('firebase_admin')
+    credentials = types.ModuleType('firebase_admin.credentials')
+    credentials.Certificate = lambda path: path
+    firestore = types.ModuleType('firebase_admin.firestore')
+    firestore.client = lambda: firestore_db
+    firestore.Query = types.SimpleNamespace(DESCENDING='DESCENDING',
+                                            ASCENDING='ASCENDING')
+    firestore.transactional = lambda function: function
+    firebase_admin.credentials = credentials
+    firebase_admin.firestore = firestore
+    firebase_admin.initialize_app = lambda *_: None
+
+    tensorflow = types.ModuleType('tensorflow')
+    tensorflow.keras = types.SimpleNamespace(
+        models=types.SimpleNamespace(load_model=lambda _: model))
+
+    sys.modules.update({
+        'board': board, 'busio': busio, 'digitalio': digitalio,
+        'adafruit_rfm69': rfm69, 'firebase_admin': firebase_admin,
+        'firebase_admin.credentials': credentials,
+        'firebase_admin.firestore': firestore, 'tensorflow': tensorflow
+    })
+
+
+def load_script(name: str, path: Path):
+    '''
+    Imports a service script by path, its __main__ block is not run
+    '''
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_master():
+    sys.path.insert(0, str(REPO_ROOT/'lora_nodes/node_core'))
+    service = load_script('master_node', REPO_ROOT/'lora_nodes/master/main.py')
+    return service.create_app(service.Master())
+
+
+def build_predictor():
+    sys.path.insert(0, str(REPO_ROOT/'stats_core'))
+    # Model files are relative to the working directory, a scratch one
+    # keeps the local cache of one run from leaking into the next
+    workdir = Path(tempfile.mkdtemp(prefix='load_tester_'))
+    os.symlink(REPO_ROOT/'data_processor/watering_model.model',
+               workdir/'watering_model.model')
+    os.chdir(workdir)
+    service = load_script('water_predictor',
+                          REPO_ROOT/'data_processor/water_predictor.py')
+    return service.create_server(service.WaterPredictor())
+
+
+class ServiceRunner:
+    '''
+    Serves a WSGI app on a background thread with the same threaded
+    werkzeug server Flask's app.run uses
+    '''
+
+    def __init__(self, app, port: int):
+        self.server = make_server('127.0.0.1', port, app, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def __exit__(self, *_):
+        self.server.shutdown()
+
+
+class LoadTester:
+    '''
+    Drives a service with concurrent clients and collects latencies
+    '''
+
+    def __init__(self, base_url: str, mix: dict, concurrency: int,
+                 duration: float, timeout: float):
+        self.base_url = base_url
+        self.paths = list(mix.keys())
+        self.weights = list(mix.values())
+        self.concurrency = concurrency
+        self.duration = duration
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.samples = {path: [] for path in self.paths}  # (latency, ok)
+
+    def client(self, deadline: float):
+        session = Session()
+        while time.perf_counter() < deadline:
+            path = random.choices(self.paths, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                rsp = session.get(self.base_url + path, timeout=self.timeout)
+                ok = rsp.status_code in (200, 304)
+                if ok and rsp.status_code == 200 and rsp.headers.get(
+                        'Content-Type', '').startswith('application/json'):
+                    ok = rsp.json().get('success', True)
+            except Exception as e:
+                logging.debug(f'Request to {path} failed: {e}')
+                ok = False
+            latency = time.perf_counter() - start
+            with self.lock:
+                self.samples[path].append((latency, ok))
+
+    def run(self):
+        start = time.perf_counter()
+        deadline = start + self.duration
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            for _ in range(self.concurrency):
+                pool.submit(self.client, deadline)
+        elapsed = time.perf_counter() - start
+        report = {path: summarize(samples, elapsed)
+                  for path, samples in self.samples.items()}
+        report['total'] = summarize(
+            [s for samples in self.samples.values() for s in samples],
+            elapsed)
+        return report
+
+
+def percentile(values: list, pct: float):
+    '''
+    Nearest-rank percentile of an already sorted list
+    '''
+    if not values:
+        return None
+    rank = max(1, int(round(pct/100*len(values))))
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(samples: list, elapsed: float):
+    latencies = sorted(latency*1000 for latency, _ in samples)
+    errors = sum(1 for _, ok in samples if not ok)
+    return {
+        'requests': len(samples),
+        'throughput_rps': len(samples)/elapsed,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'error_rate': errors/len(samples) if samples else 0.0
+    }
+
+
+def print_report(report: dict, baseline: dict = None):
+    columns = ['requests', 'throughput_rps', 'p50_ms', 'p95_ms',
+               'p99_ms', 'error_rate']
+    width = max(len(path) for path in report) + 2
+    print(f'{"endpoint":<{width}}' + ''.join(f'{c:>16}' for c in columns))
+    for path, stats in report.items():
+        row = f'{path:<{width}}'
+        for column in columns:
+            value = stats[column]
+            cell = '-' if value is None else f'{value:.3f}'
+            old = (baseline or {}).get(path, {}).get(column)
+            if value is not None and old:  # Relative change to baseline
+                cell += f' ({(value - old)/old*100:+.0f}%)'
+            row += f'{cell:>16}'
+        print(row)
+
+
+def parse_mix(mix: list):
+    '''
+    Parses ["/temp:3", "/hmdt"] into request weights, the weight defaults to 1
+    '''
+    weights = {}
+    for item in mix:
+        path, _, weight = item.rpartition(':')
+        if not path:
+            path, weight = weight, 1
+        weights[path] = float(weight)
+    return weights
+
+
+DEFAULT_MIX = {
+    'master': ['/temp:1', '/hmdt:1'],
+    'predictor': ['/water:4', '/series:2', '/drift:1',
+                  '/scenarios?rain_24h=0,5,10&temp=5,10,15:1']
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('service', choices=['master', 'predictor'])
+    parser.add_argument('--url', help='test a running instance instead '
+                        'of starting one against fakes')
+    parser.add_argument('--mix', nargs='+',
+                        help='weighted paths, e.g. /temp:3 /hmdt:1')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='per request, seconds')
+    parser.add_argument('--radio-latency', type=float,
+                        default=SimulatedRadio.latency)
+    parser.add_argument('--radio-loss', type=float,
+                        default=SimulatedRadio.loss)
+    parser.add_argument('--model-latency', type=float,
+                        default=StubModel.latency)
+    parser.add_argument('--save-baseline', help='write the report to a file')
+    parser.add_argument('--compare', help='baseline file to compare against')
+    args = parser.parse_args()
+    # The predictor changes directory, so resolve paths up front
+    for path in ['save_baseline', 'compare']:
+        if getattr(args, path):
+            setattr(args, path, os.path.abspath(getattr(args, path)))
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    SimulatedRadio.latency = args.radio_latency
+    SimulatedRadio.loss = args.radio_loss
+    StubModel.latency = args.model_latency
+    mix = parse_mix(args.mix or DEFAULT_MIX[args.service])
+
+    if args.url:
+        tester = LoadTester(args.url.rstrip('/'), mix, args.concurrency,
+                            args.duration, args.timeout)
+        report = tester.run()
+    else:
+        install_fakes(FakeFirestore(), StubModel())
+        app = build_master() if args.service == 'master' \
+            else build_predictor()
+        with ServiceRunner(app, 0) as base_url:
+            tester = LoadTester(base_url, mix, args.concurrency,
+                                args.duration, args.timeout)
+            report = tester.run()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(report, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,85 +1,114 @@
 #!/usr/local/bin/python
+import heapq
+import itertools
 import logging
+import queue
+import threading
 import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-import adafruit_rfm69
-import board
-import busio
-import digitalio
-from requests import get as api_get
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from node_core import LoRa, encode_command
 
-class LoRa:
+
+class PumpCommand:
     '''
-    This class handles communication to the sensor pi
-    The channel is encrypted to prevent interference from other LoRa devices,
-    It does not serve a security purpose, hence the weak encryption key
+    A single pump dose queued for the satellite, the id lets the satellite
+    ignore a resent command it already dispensed
     '''
-    __SIGNAL_FREQUENCY = 915.0
-    __ENCRYPTION_KEY = b"\x01\x01\x01\x01\x01\x01\x01\x01\x02\x02\x02\x02\x02\x02\x02\x02"
-    __PINS = {
-        'miso': board.MISO,
-        'mosi': board.MOSI,
-        'sck': board.SCK,
-        'cs': board.D22,
-        'rst': board.D27
-    }
-    __PACKET_WAIT = 2
-    __MAX_ATTEMPTS = 5
 
-    def __init__(self):
-        '''
-        Initializes the SPI channel and the RMF69 python API
-        '''
-        spi = busio.SPI(self.__PINS['sck'],
-                        MOSI=self.__PINS['mosi'],
-                        MISO=self.__PINS['miso'])
-        cs = digitalio.DigitalInOut(self.__PINS['cs'])
-        rst = digitalio.DigitalInOut(self.__PINS['rst'])
-        self.lora = adafruit_rfm69.RFM69(spi, cs, rst, self.__SIGNAL_FREQUENCY)
-        self.lora.encryption_key = self.__ENCRYPTION_KEY
-        logging.debug(
-            f'Init\'d LoRa board with freq: {self.lora.frequency_mhz}, bitrate: {self.lora.bitrate / 1000} kbit/s, f. deviation: {self.lora.frequency_deviation/1000} khz, and encryption key: {self.lora.encryption_key}')
+    def __init__(self, zone: dict, volume: int):
+        self.zone = zone
+        self.volume = volume
+        self.dose_id = uuid.uuid4().hex[:8]  # Fits in the command packet
+        self.attempts = 0
+        self.confirmed = False
 
-    def receive_message(self):
-        '''
-        Waits for a message with a 2 second timeout
-        '''
-        logging.debug('Waiting for message...')
-        packets = self.lora.receive(timeout=self.__PACKET_WAIT)
-        if packets:
-            logging.debug(f'Got packets: {packets}')
-            return packets
-        return False
+    def as_dict(self):
+        return {
+            'zone': self.zone['name'],
+            'dose_id': self.dose_id,
+            'volume': self.volume,
+            'attempts': self.attempts,
+            'confirmed': self.confirmed
+        }
 
-    def send_message(self, message):
+
+class Dispatcher:
+    '''
+    Sends the queued pump commands from a single thread, so the radio is
+    never shared, and tracks which ones the satellite confirmed
+    '''
+    __MAX_ATTEMPTS = 3
+    # Seconds before an unconfirmed command is resent, which is safe as
+    # the satellite only confirms a dose id it has already dispensed
+    __RETRY_DELAY = 60
+    __FLOW_RATE = 130  # ml/min, the satellite is busy while it dispenses
+
+    def __init__(self, com: LoRa):
+        self.com = com
+        self.queue = queue.Queue()
+        self.history = deque(maxlen=100)  # Finished commands
+        self.busy_until = 0  # Time the satellite's pump stops
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, zone: dict, volume: int):
+        self.queue.put(PumpCommand(zone, volume))
+
+    def pop_history(self):
         '''
-        Sends a message
+        Returns the commands finished since the last call as dicts
         '''
-        logging.debug(f'Sending message: {message}')
-        packets = bytes(message, 'utf-8')
-        self.lora.send(packets)
+        finished = []
+        while self.history:
+            finished.append(self.history.popleft().as_dict())
+        return finished
 
-    def send_and_wait(self, message):
+    def send(self, command: PumpCommand):
         '''
-        Sends a message, waits for a responce,
-        and retries up to 4 times if no reply is detected
+        Sends a command once the satellite's pump is idle,
+        returns whether the satellite confirmed it
         '''
-        attempt = 0
-        max_attempts = self.__MAX_ATTEMPTS
-        waiting_for_response = True
-        response = None
-
-        while waiting_for_response:
-            logging.debug(f'Attempt {attempt}...')
-            attempt += 1
-
-            self.send_message(message)
-            response = self.receive_message()
-
-            if attempt > max_attempts or response:
-                waiting_for_response = False
-        return response
+        time.sleep(max(0, self.busy_until - time.time()))
+        command.attempts += 1
+        sent_at = time.time()
+        try:
+            rsp = self.com.send_and_wait(encode_command(
+                'iot_pmp_ctrl', f'{command.volume},{command.dose_id}'))
+        finally:
+            # A lost OK or a radio error does not mean the pump is idle,
+            # so wait for it either way
+            self.busy_until = sent_at + command.volume*60/self.__FLOW_RATE
+        return rsp == b'OK'
+
+    def run(self):
+        while True:  # Run forever
+            command = self.queue.get()
+            try:
+                command.confirmed = self.send(command)
+            except Exception as e:  # Keeps the only worker thread alive
+                logging.error(f'Failed to send the dose for zone '
+                              f'{command.zone["name"]}: {e}')
+                command.confirmed = False
+            if command.confirmed:
+                logging.info(f'Zone {command.zone["name"]} is dispensing '
+                             f'{command.volume} ml')
+            elif command.attempts < self.__MAX_ATTEMPTS:
+                logging.warning(f'No confirmation from zone '
+                                f'{command.zone["name"]}, retrying')
+                threading.Timer(self.__RETRY_DELAY, self.queue.put,
+                                [command]).start()
+                continue
+            else:
+                logging.error(f'Zone {command.zone["name"]} never confirmed '
+                              f'{command.volume} ml')
+            self.history.append(command)
 
 
 class Irrigator:
@@ -87,39 +116,108 @@ class Irrigator:
     Main class for running the automated plant watering
     '''
     __API_ENDPOINT = "http://api.maxhunt.design/water"
+    __TIMEOUT = (3.05, 30)  # Seconds to connect and to read
+    __PERIOD = 60*60*24  # One watering day
+    # The predicted volume is per square metre and is split into several
+    # doses through the day. All zones are watered by the one satellite's
+    # pump, one dose at a time: packets are broadcast without RFM69
+    # addressing, so a second satellite would dispense every zone's doses
+    __ZONES = [
+        {'name': 'garden', 'area_m2': 1, 'doses': 1,
+         'endpoint': __API_ENDPOINT}
+    ]
 
     def __init__(self):
         '''
-        Initializes the LoRa class
+        Initializes the LoRa class, the HTTP session and the dispatcher
         '''
         self.com = LoRa()
-        self.yesterday_water = 0
-
-    def get_today_watering_vol(self):
+        self.session = Session()  # Pooled, keeps connections alive
+        adapter = HTTPAdapter(pool_maxsize=len(self.__ZONES),
+                              max_retries=Retry(total=2, backoff_factor=1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.dispatcher = Dispatcher(self.com)
+        self.yesterday_water = {}  # Endpoint -> last known volume per m2
+        self.dose_counter = itertools.count()  # Orders doses due together
+
+    def get_today_watering_vol(self, endpoint: str = __API_ENDPOINT):
         '''
-        Gets the day's predicted watering volume and dispenses the
-        relevant volume into the plants
+        Gets the day's predicted watering volume per square metre,
+        falling back to yesterday's value if the server fails
         '''
-        endpoint = self.__API_ENDPOINT
-        rsp = api_get(endpoint)
-        if rsp.status_code != 200:
-            logging.error(f'Got code {rsp.status_code} from server, '
+        try:
+            rsp = self.session.get(endpoint, timeout=self.__TIMEOUT)
+            if rsp.status_code != 200:
+                raise ValueError(f'got code {rsp.status_code}')
+            today_water = int(rsp.json().get('value'))
+        except Exception as e:
+            logging.error(f'Could not get the volume from {endpoint}: {e}, '
                           f'using yesterday\'s value')
-            return self.yesterday_water
-        today_water = int(rsp.json().get('value'))
-        self.yesterday_water = today_water
+            return self.yesterday_water.get(endpoint, 0)
+        self.yesterday_water[endpoint] = today_water
         return today_water
 
-    def send_watering_command(self, volume: int):
-        self.com.send_and_wait(f'iot_pmp_ctrl|{str(volume)}')
+    def get_zone_volumes(self):
+        '''
+        Fetches the volume of every zone, one request per predictor
+        endpoint, all of them concurrently
+        '''
+        endpoints = {zone['endpoint'] for zone in self.__ZONES}
+        with ThreadPoolExecutor(len(endpoints)) as pool:
+            per_m2 = dict(zip(endpoints, pool.map(
+                self.get_today_watering_vol, endpoints)))
+        return [(zone, per_m2[zone['endpoint']]*zone['area_m2'])
+                for zone in self.__ZONES]
+
+    def schedule_doses(self, schedule: list, day_start: float):
+        '''
+        Splits each zone's volume into evenly spaced doses
+        and adds them to the schedule
+        '''
+        for zone, volume in self.get_zone_volumes():
+            dose = int(volume/zone['doses'])
+            for n in range(zone['doses']):
+                due = day_start + n*self.__PERIOD/zone['doses']
+                heapq.heappush(
+                    schedule, (due, next(self.dose_counter), zone, dose))
+
+    def log_history(self):
+        '''
+        Reports the doses finished since the last report, unconfirmed
+        ones may or may not have been dispensed and need checking
+        '''
+        doses = self.dispatcher.pop_history()
+        unconfirmed = [dose for dose in doses if not dose['confirmed']]
+        logging.info(f'{len(doses) - len(unconfirmed)} of {len(doses)} '
+                     f'doses confirmed since the last report')
+        for dose in unconfirmed:
+            logging.warning(f'Unconfirmed dose: {dose}')
 
     def mainloop(self):
+        '''
+        Drift-free loop, every day starts exactly one period after the
+        previous one, however long the requests or commands took
+        '''
+        next_day = time.time()
+        schedule = []  # Heap of (due time, tie breaker, zone, volume)
         while True:  # Run forever
-            watering_vol = self.get_today_watering_vol()
-            self.send_watering_command(watering_vol)
-            time.sleep(60*60*24)
+            now = time.time()
+            if now >= next_day:
+                if now - next_day > self.__PERIOD:  # e.g. after a suspend
+                    logging.warning('Missed a watering day, resyncing')
+                    next_day = now
+                self.log_history()
+                self.schedule_doses(schedule, next_day)
+                next_day += self.__PERIOD
+            while schedule and schedule[0][0] <= now:
+                _, _, zone, volume = heapq.heappop(schedule)
+                self.dispatcher.submit(zone, volume)
+            wake_at = min([next_day] + [due for due, *_ in schedule[:1]])
+            time.sleep(max(0, wake_at - time.time()))
 
 
 if __name__ == "__main__":
+    logging.root.setLevel(logging.INFO)
     irrigator = Irrigator()  # init the Irrigator class and children
     irrigator.mainloop()  # run the main loop
@@ -1,94 +1,17 @@
 #!/usr/local/bin/python
-import board
-import busio
-import digitalio
 import logging
-from flask import Flask
+import zlib
+from flask import Flask, request
 
-import adafruit_rfm69
-
-
-class LoRa:
-    '''
-    This class handles communication to the sensor pi
-    The channel is encrypted to prevent interference from other LoRa devices,
-    It does not serve a security purpose, hence the weak encryption key
-    '''
-    __SIGNAL_FREQUENCY = 915.0
-    __ENCRYPTION_KEY = b"\x01\x01\x01\x01\x01\x01\x01\x01\x02\x02\x02\x02\x02\x02\x02\x02"
-    __PINS = {
-        'miso': board.MISO,
-        'mosi': board.MOSI,
-        'sck': board.SCK,
-        'cs': board.D22,
-        'rst': board.D27
-    }
-    __PACKET_WAIT = 2
-    __MAX_ATTEMPTS = 5
-
-    def __init__(self):
-        '''
-        Initializes the SPI channel and the RMF69 python API
-        '''
-        spi = busio.SPI(self.__PINS['sck'],
-                        MOSI=self.__PINS['mosi'],
-                        MISO=self.__PINS['miso'])
-        cs = digitalio.DigitalInOut(self.__PINS['cs'])
-        rst = digitalio.DigitalInOut(self.__PINS['rst'])
-        self.lora = adafruit_rfm69.RFM69(spi, cs, rst, self.__SIGNAL_FREQUENCY)
-        self.lora.encryption_key = self.__ENCRYPTION_KEY
-        logging.debug(
-            f'Init\'d LoRa board with freq: {self.lora.frequency_mhz}'
-            f', bitrate: {self.lora.bitrate / 1000} kbit/s, f. deviation: '
-            f'{self.lora.frequency_deviation/1000} khz, and encryption key: '
-            f'{self.lora.encryption_key}')
-
-    def receive_message(self):
-        '''
-        Waits for a message with a 2 second timeout
-        '''
-        logging.debug('Waiting for message...')
-        packets = self.lora.receive(timeout=self.__PACKET_WAIT)
-        if packets:
-            logging.debug(f'Got packets: {packets}')
-            return packets
-        return False
-
-    def send_message(self, message: any):
-        '''
-        Sends a message
-        '''
-        logging.debug(f'Sending message: {message}')
-        packets = bytes(message, 'utf-8')
-        self.lora.send(packets)
-
-    def send_and_wait(self, message):
-        '''
-        Sends a message, waits for a responce,
-        and retries up to 4 times if no reply is detected
-        '''
-        attempt = 0
-        max_attempts = self.__MAX_ATTEMPTS
-        waiting_for_response = True
-        response = None
-
-        while waiting_for_response:
-            logging.debug(f'Attempt {attempt}...')
-            attempt += 1
-
-            self.send_message(message)
-            response = self.receive_message()
-
-            if attempt > max_attempts or response:
-                waiting_for_response = False
-
-        return response
+from node_core import LoRa, encode_command, unpack_readings
 
 
 class Master:
     '''
     Main class for sending LoRa commands and parsing responces
     '''
+    __TRANSFER_ROUNDS = 4  # Selective retransmit requests per transfer
+    __MAX_REQUEST = 50  # Characters of fragment indexes per request
 
     def __init__(self):
         '''
@@ -97,37 +20,87 @@ class Master:
         '''
         self.com = LoRa()
         logging.info('Pining slave')
-        rsp = self.com.send_and_wait('ping|')
+        rsp = self.com.send_and_wait(encode_command('ping'))
         print(f'Satellite is {rsp}')
 
     def get_temp(self):
-        temp = self.com.send_and_wait('iot_g_temp|')
+        temp = self.com.send_and_wait(encode_command('iot_g_temp'))
         logging.info(f'Got temp from satellite: {temp}ºC')
         if temp:
             return float("{:.1f}".format(float(temp.decode())))
         return 0
 
     def get_hmdt(self):
-        hmdt = self.com.send_and_wait('iot_g_hmdt|')
+        hmdt = self.com.send_and_wait(encode_command('iot_g_hmdt'))
         logging.info(f'Got hmdt from satellite: {hmdt}')
         if hmdt:
             return int(hmdt.decode())
         return 0
 
+    def request_fragments(self, missing: list, total: int):
+        '''
+        Requests the missing fragments, all of them with an empty list,
+        and returns the ones received
+        '''
+        if len(missing) == total:
+            indexes = ''
+        else:  # Ask for as many as fit in one packet, the rest next round
+            indexes = ''
+            for index in missing:
+                if len(indexes) + len(str(index)) + 1 > self.__MAX_REQUEST:
+                    break
+                indexes += f'{index},'
+            indexes = indexes.rstrip(',')
+        self.com.send_message(encode_command('iot_g_frag', indexes))
+        timeout = self.com.get_link_stats().timeout
+        return self.com.receive_burst(len(missing), timeout)
+
+    def get_log(self, since: int = 0):
+        '''
+        Downloads the readings the satellite buffered after sequence
+        number since, in compressed fragments with selective retransmit
+        '''
+        header = self.com.send_and_wait(encode_command('iot_g_log', since))
+        if not header or not header.startswith(b'LOG|'):
+            logging.error(f'Unexpected log header: {header}')
+            return None
+        _, total, crc = header.decode().split('|')
+        total, crc = int(total), int(crc)
+        fragments = {}
+        for _ in range(self.__TRANSFER_ROUNDS):
+            missing = [i for i in range(total) if i not in fragments]
+            if not missing:
+                break
+            fragments.update(self.request_fragments(missing, total))
+        if len(fragments) < total:
+            logging.error(f'Got {len(fragments)} of {total} fragments')
+            return None
+        payload = b''.join(fragments[i] for i in range(total))
+        if zlib.crc32(payload) != crc:
+            logging.error('Log transfer failed the checksum')
+            return None
+        readings = unpack_readings(payload)
+        logging.info(f'Got {len(readings)} buffered readings '
+                     f'in {total} fragments')
+        return readings
+
     def run_pump(self, volume):
-        status = self.com.send_and_wait(f'iot_pmp_ctrl|{str(volume)}')
+        status = self.com.send_and_wait(
+            encode_command('iot_pmp_ctrl', volume))
         logging.info(status)
         return status.decode()
 
 
-if __name__ == "__main__":
-    logging.root.setLevel(logging.DEBUG)
-    master = Master()  # init the master class
-
+def create_app(master: Master):
+    '''
+    Builds the HTTP API in front of the master node
+    '''
     node = Flask(__name__)  # inint the Flask app
 
-    prev_temp = master.get_temp()  # Get initial readings
-    prev_hmdt = master.get_hmdt()
+    previous = {  # Get initial readings
+        'temp': master.get_temp(),
+        'hmdt': master.get_hmdt()
+    }
 
     @node.route("/")
     def root():  # Return a generic message if the server is alive
@@ -135,23 +108,43 @@ if __name__ == "__main__":
 
     @node.route("/hmdt")
     def humidity():  # return the measured humidity
-        global prev_hmdt
         humidity = master.get_hmdt()
         if humidity:
-            prev_hmdt = humidity
+            previous['hmdt'] = humidity
             return {'success': True, 'value': humidity}
         # If humidity could not be measured, return the previous value
-        return {'success': False, 'value': prev_hmdt}
+        return {'success': False, 'value': previous['hmdt']}
 
     @node.route("/temp")
     def temp():  # return the measured temperature
-        global prev_temp
         temp = master.get_temp()
         if temp:
-            prev_temp = temp
+            previous['temp'] = temp
             return {'success': True, 'value': temp}
         # If temperature could not be measured, return the previous value
-        return {'success': False, 'value': prev_temp}
+        return {'success': False, 'value': previous['temp']}
+
+    @node.route("/log")
+    def log():  # return the readings buffered on the satellite
+        since = request.args.get('since', 0, type=int)
+        readings = master.get_log(since)
+        if readings is None:
+            return {'success': False, 'value': []}
+        return {'success': True, 'value': readings}
+
+    @node.route("/link")
+    def link():  # return the radio link statistics of every peer
+        return {'success': True,
+                'value': {peer: stats.as_dict()
+                          for peer, stats in master.com.link_stats.items()}}
+
+    return node
+
+
+if __name__ == "__main__":
+    logging.root.setLevel(logging.DEBUG)
+    master = Master()  # init the master class
+    node = create_app(master)
 
-    # Start the server
+    # Start the server
     node.run(host='0.0.0.0', port='3333', use_reloader=False)
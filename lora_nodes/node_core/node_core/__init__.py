@@ -0,0 +1,16 @@
+'''
+Shared core of the LoRa nodes: the radio driver, the command
+dispatch table and the packet framing. Hardware libraries are
+only imported once a radio is created
+'''
+from .dispatch import CommandDispatcher
+from .framing import (encode_command, fragment, pack_fragment,
+                      pack_readings, split_command, unpack_fragment,
+                      unpack_readings)
+from .radio import LinkStats, LoRa
+
+__all__ = [
+    'CommandDispatcher', 'LinkStats', 'LoRa', 'encode_command', 'fragment',
+    'pack_fragment', 'pack_readings', 'split_command', 'unpack_fragment',
+    'unpack_readings'
+]
@@ -0,0 +1,34 @@
+'''
+Measures the command dispatch loop without a radio
+
+    python -m node_core.benchmark
+'''
+import logging
+import timeit
+
+from .dispatch import CommandDispatcher
+
+COMMANDS = ['ping', 'iot_g_temp', 'iot_g_hmdt', 'iot_pmp_ctrl']
+PACKETS = [b'ping|', b'iot_g_temp|', b'iot_pmp_ctrl|250', b'bogus|'] * 250
+
+
+def benchmark_dispatch(number: int = 10, repeat: int = 5):
+    '''
+    Returns the best time per packet in seconds, a quarter of the
+    packets are unknown commands
+    '''
+    dispatcher = CommandDispatcher()
+    for command in COMMANDS:
+        dispatcher.register(command, lambda argument: None)
+
+    def run():
+        dispatcher.serve(iter(PACKETS).__next__, max_packets=len(PACKETS))
+
+    logging.disable(logging.WARNING)  # Keep the unknown commands quiet
+    best = min(timeit.repeat(run, number=number, repeat=repeat))
+    logging.disable(logging.NOTSET)
+    return best / number / len(PACKETS)
+
+
+if __name__ == '__main__':
+    print(f'{benchmark_dispatch() * 1e6:.2f} us per packet')
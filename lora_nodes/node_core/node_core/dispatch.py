@@ -0,0 +1,70 @@
+'''
+Command dispatch table and loop for the nodes listening for instructions
+'''
+import logging
+
+from .framing import split_command
+
+
+class CommandDispatcher:
+    '''
+    Maps command names to handlers. Packets are looked up by their raw
+    name, so unknown commands are rejected without decoding them and
+    without raising, and errors inside a handler are logged with its name
+    '''
+
+    def __init__(self):
+        self.handlers = {}
+        self.handled = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def register(self, name: str, handler):
+        '''
+        Adds a handler, it is called with the command's argument string
+        '''
+        self.handlers[name.encode()] = handler
+
+    def dispatch(self, packet: bytes):
+        '''
+        Runs the handler of a single packet, returns whether it succeeded
+        '''
+        name, argument = split_command(packet)
+        handler = self.handlers.get(name)
+        if handler is None:
+            self.rejected += 1
+            logging.warning(f'Unknown command: {packet}')
+            return False
+        try:
+            argument = argument.decode()
+        except UnicodeDecodeError:
+            self.rejected += 1
+            logging.warning(f'Undecodable argument: {packet}')
+            return False
+        try:
+            handler(argument)
+        except Exception as e:
+            self.failed += 1
+            logging.error(f'Command {name.decode()} failed: {e}')
+            return False
+        self.handled += 1
+        return True
+
+    def serve(self, receive, idle=None, max_packets: int = None):
+        '''
+        Dispatches packets from receive() until max_packets have been
+        handled, forever by default. idle() runs between packets.
+        Feeding it a list's iterator benchmarks the dispatch overhead
+        '''
+        count = 0
+        while max_packets is None or count < max_packets:
+            if idle is not None:
+                idle()
+            packet = receive()
+            if not packet:
+                continue
+            logging.debug(f'Got command: {packet}')
+            self.dispatch(packet)
+            count += 1
+        return count
+
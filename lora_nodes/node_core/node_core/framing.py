@@ -0,0 +1,65 @@
+'''
+Packet formats shared by the nodes
+
+Commands are sent as "<name>|<argument>" text packets.
+Bulk transfers are split into fragments prefixed with their index.
+'''
+import struct
+import zlib
+
+COMMAND_SEPARATOR = b'|'
+MAX_PACKET = 60  # RFM69 payload limit in bytes
+FRAGMENT_HEADER = struct.Struct('>H')  # Fragment index
+FRAGMENT_SIZE = MAX_PACKET - FRAGMENT_HEADER.size
+# seq, timestamp, temperature in centi-degrees, moisture
+READING_RECORD = struct.Struct('>IIhh')
+
+
+def encode_command(name: str, argument: any = ''):
+    '''
+    Builds a command packet
+    '''
+    return f'{name}|{argument}'
+
+
+def split_command(packet: bytes):
+    '''
+    Splits a command packet into its name and argument, both stay as
+    bytes so the name can be looked up before anything is decoded
+    '''
+    name, _, argument = packet.partition(COMMAND_SEPARATOR)
+    return name, argument
+
+
+def fragment(payload: bytes, size: int = FRAGMENT_SIZE):
+    '''
+    Splits a payload into fragments that fit in a packet
+    '''
+    return [payload[i:i + size] for i in range(0, len(payload), size)]
+
+
+def pack_fragment(index: int, chunk: bytes):
+    return FRAGMENT_HEADER.pack(index) + chunk
+
+
+def unpack_fragment(packet: bytes):
+    index, = FRAGMENT_HEADER.unpack_from(packet)
+    return index, packet[FRAGMENT_HEADER.size:]
+
+
+def pack_readings(readings):
+    '''
+    Packs (seq, timestamp, centi-degrees, moisture) tuples and compresses them
+    '''
+    records = b''.join(READING_RECORD.pack(*reading) for reading in readings)
+    return zlib.compress(records, 9)
+
+
+def unpack_readings(payload: bytes):
+    '''
+    Reverses pack_readings, returns the readings as dicts
+    '''
+    return [{'seq': seq, 'timestamp': timestamp,
+             'temp': temp/100, 'hmdt': hmdt}
+            for seq, timestamp, temp, hmdt
+            in READING_RECORD.iter_unpack(zlib.decompress(payload))]
@@ -0,0 +1,196 @@
+'''
+RFM69 radio driver shared by the master, irrigator and satellite nodes
+'''
+import logging
+import time
+
+from .framing import FRAGMENT_HEADER, unpack_fragment
+
+
+class LinkStats:
+    '''
+    Round trip time and signal statistics of a single peer.
+    The receive timeout follows the SRTT/RTTVAR estimator from RFC 6298
+    and backs off exponentially while replies are being lost
+    '''
+    __ALPHA = 1/8  # SRTT gain
+    __BETA = 1/4  # RTTVAR gain
+    __RSSI_GAIN = 1/4
+    __INITIAL_TIMEOUT = 2  # Seconds, used until the first reply arrives
+    # The satellite waits 0.5 s before every reply, a floor above that
+    # delay plus the sensor read and airtime avoids spurious retransmits
+    __MIN_TIMEOUT = 1
+    __MAX_TIMEOUT = 4
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.timeout = self.__INITIAL_TIMEOUT
+        self.rssi = None  # Smoothed, in dBm
+        self.sent = 0
+        self.replies = 0
+        self.losses = 0
+
+    def on_reply(self, rtt: float, rssi: float = None,
+                 retransmitted: bool = False):
+        '''
+        Records a reply, RTT samples of retransmitted messages are ambiguous
+        and are skipped (Karn's algorithm)
+        '''
+        self.replies += 1
+        if rssi is not None:
+            self.rssi = rssi if self.rssi is None else (
+                self.rssi + self.__RSSI_GAIN*(rssi - self.rssi))
+        if retransmitted:
+            return
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt/2
+        else:
+            self.rttvar += self.__BETA*(abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.__ALPHA*(rtt - self.srtt)
+        timeout = self.srtt + 4*self.rttvar
+        self.timeout = min(max(timeout, self.__MIN_TIMEOUT),
+                           self.__MAX_TIMEOUT)
+
+    def on_timeout(self):
+        '''
+        Records a lost reply and backs off the timeout
+        '''
+        self.losses += 1
+        self.timeout = min(self.timeout*2, self.__MAX_TIMEOUT)
+
+    def as_dict(self):
+        return {
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+            'timeout': self.timeout,
+            'rssi': self.rssi,
+            'sent': self.sent,
+            'replies': self.replies,
+            'losses': self.losses
+        }
+
+
+class LoRa:
+    '''
+    This class handles communication to the sensor pi
+    The channel is encrypted to prevent interference from other LoRa devices,
+    It does not serve a security purpose, hence the weak encryption key
+    '''
+    __SIGNAL_FREQUENCY = 915.0
+    __ENCRYPTION_KEY = b"\x01\x01\x01\x01\x01\x01\x01\x01\x02\x02\x02\x02\x02\x02\x02\x02"
+    __PINS = {  # Names of the board pins, resolved once the board is loaded
+        'miso': 'MISO',
+        'mosi': 'MOSI',
+        'sck': 'SCK',
+        'cs': 'D22',
+        'rst': 'D27'
+    }
+    __MAX_ATTEMPTS = 6
+    __WEAK_ATTEMPTS = 8  # Used when the signal is weak
+    __WEAK_RSSI = -90  # dBm
+    __MAX_WAIT = 12  # Seconds, worst case of the old fixed timeouts
+
+    def __init__(self):
+        '''
+        Initializes the SPI channel and the RMF69 python API,
+        the hardware libraries are only imported here
+        '''
+        import adafruit_rfm69
+        import board
+        import busio
+        import digitalio
+
+        pins = {name: getattr(board, pin)
+                for name, pin in self.__PINS.items()}
+        spi = busio.SPI(pins['sck'], MOSI=pins['mosi'], MISO=pins['miso'])
+        cs = digitalio.DigitalInOut(pins['cs'])
+        rst = digitalio.DigitalInOut(pins['rst'])
+        self.lora = adafruit_rfm69.RFM69(spi, cs, rst, self.__SIGNAL_FREQUENCY)
+        self.lora.encryption_key = self.__ENCRYPTION_KEY
+        self.link_stats = {}  # LinkStats of each peer
+        logging.debug(
+            f'Init\'d LoRa board with freq: {self.lora.frequency_mhz}'
+            f', bitrate: {self.lora.bitrate / 1000} kbit/s, f. deviation: '
+            f'{self.lora.frequency_deviation/1000} khz, and encryption key: '
+            f'{self.lora.encryption_key}')
+
+    def receive_message(self, timeout: float = 2):
+        '''
+        Waits for a message with a 2 second default timeout
+        '''
+        logging.debug('Waiting for message...')
+        packets = self.lora.receive(timeout=timeout)
+        if packets:
+            logging.debug(f'Got packets: {packets}')
+            return packets
+        return False
+
+    def send_message(self, message: any):
+        '''
+        Sends a message
+        '''
+        logging.debug(f'Sending message: {message}')
+        packets = bytes(message, 'utf-8')
+        self.lora.send(packets)
+
+    def send_bytes(self, packets: bytes):
+        '''
+        Sends a binary packet, used for bulk transfers
+        '''
+        self.lora.send(packets)
+
+    def receive_burst(self, count: int, timeout: float):
+        '''
+        Receives up to count index-prefixed fragments,
+        stops once no packet arrives within the timeout
+        '''
+        fragments = {}
+        while len(fragments) < count:
+            packet = self.receive_message(timeout)
+            if not packet:
+                break
+            if len(packet) > FRAGMENT_HEADER.size:
+                index, chunk = unpack_fragment(packet)
+                fragments[index] = chunk
+        return fragments
+
+    def get_link_stats(self, peer: str = 'satellite'):
+        '''
+        Returns the link statistics of a peer, creating them if needed
+        '''
+        if peer not in self.link_stats:
+            self.link_stats[peer] = LinkStats()
+        return self.link_stats[peer]
+
+    def send_and_wait(self, message, peer: str = 'satellite'):
+        '''
+        Sends a message and waits for a responce, retrying with
+        the peer's adaptive timeout until the attempts or the
+        total wait budget run out. Weak links get more attempts
+        '''
+        stats = self.get_link_stats(peer)
+        max_attempts = self.__MAX_ATTEMPTS
+        if stats.rssi is not None and stats.rssi < self.__WEAK_RSSI:
+            max_attempts = self.__WEAK_ATTEMPTS
+        deadline = time.monotonic() + self.__MAX_WAIT
+        response = False
+
+        for attempt in range(max_attempts):
+            timeout = min(stats.timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                break
+            logging.debug(f'Attempt {attempt}, timeout {timeout:.2f}s...')
+            sent_at = time.monotonic()
+            self.send_message(message)
+            stats.sent += 1
+            response = self.receive_message(timeout)
+            if response:
+                stats.on_reply(time.monotonic() - sent_at,
+                               getattr(self.lora, 'last_rssi', None),
+                               retransmitted=attempt > 0)
+                break
+            stats.on_timeout()
+
+        return response
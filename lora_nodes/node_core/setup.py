@@ -0,0 +1,16 @@
+from setuptools import setup
+
+setup(
+    name='node_core',
+    version='1.0.0',
+    description='Shared LoRa radio driver and command dispatch '
+                'for the IoT-ICL DE nodes',
+    packages=['node_core'],
+    python_requires='>=3.7',
+    extras_require={
+        'hardware': [
+            'Adafruit-Blinka==5.9.1',
+            'adafruit-circuitpython-rfm69==2.1.0'
+        ]
+    }
+)
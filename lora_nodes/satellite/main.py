@@ -1,79 +1,116 @@
 #!/usr/local/bin/python
-import board
-import busio
-import digitalio
+import json
+import os
 import time
 import logging
+import zlib
+from collections import deque
 
-import adafruit_rfm69
-from adafruit_seesaw.seesaw import Seesaw
+from node_core import (CommandDispatcher, LoRa, fragment, pack_fragment,
+                       pack_readings)
 
 
-class LoRa:
+def write_atomically(path: str, data: any):
     '''
-    This class handles communication to the sensor pi
-    The channel is encrypted to prevent interference from other LoRa devices,
-    It does not serve a security purpose, hence the weak encryption key
+    Writes json to a temporary file and renames it into place, so a
+    power cut leaves the old or the new file, never a truncated one
     '''
-    __SIGNAL_FREQUENCY = 915.0
-    __ENCRYPTION_KEY = b"\x01\x01\x01\x01\x01\x01\x01\x01\x02\x02\x02\x02\x02\x02\x02\x02"
-    __PINS = {
-        'miso': board.MISO,
-        'mosi': board.MOSI,
-        'sck': board.SCK,
-        'cs': board.D22,
-        'rst': board.D27
-    }
-    __PACKET_WAIT = 2
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as tmp_file:
+        json.dump(data, tmp_file)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, path)
 
-    def __init__(self):
-        '''
-        Initializes the SPI channel and the RMF69 python API
-        '''
-        spi = busio.SPI(self.__PINS['sck'],
-                        MOSI=self.__PINS['mosi'],
-                        MISO=self.__PINS['miso'])
-        cs = digitalio.DigitalInOut(self.__PINS['cs'])
-        rst = digitalio.DigitalInOut(self.__PINS['rst'])
-        self.lora = adafruit_rfm69.RFM69(spi, cs, rst, self.__SIGNAL_FREQUENCY)
-        self.lora.encryption_key = self.__ENCRYPTION_KEY
-        logging.debuddg(
-            f'Init\'d LoRa board with freq: {self.lora.frequency_mhz}, '
-            f'bitrate: {self.lora.bitrate / 1000} kbit/s, f. deviation: '
-            f'{self.lora.frequency_deviation/1000} khz, and encryption key: '
-            f'{self.lora.encryption_key}')
 
-    def receive_message(self):
+class ReadingBuffer:
+    '''
+    Bounded ring buffer of timestamped sensor readings, saved to disk
+    so the history survives restarts while the master is unreachable
+    '''
+    __PATH = 'readings_buffer.json'
+    __CAPACITY = 24*7  # A week of hourly readings
+
+    def __init__(self, path: str = __PATH, capacity: int = __CAPACITY):
+        self.path = path
+        self.readings = deque(maxlen=capacity)
+        self.next_seq = 1
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as buffer_file:
+                    saved = json.load(buffer_file)
+                readings = [tuple(r) for r in saved['readings']]
+                next_seq = int(saved['next_seq'])
+            except (ValueError, KeyError, TypeError) as e:
+                logging.warning(f'Discarding unreadable buffer: {e}')
+                # Stays above the sequence numbers the master has seen
+                self.next_seq = int(time.time())
+            else:
+                self.readings.extend(readings)
+                self.next_seq = next_seq
+        logging.debug(f'Loaded {len(self.readings)} buffered readings')
+
+    def append(self, temp: float, hmdt: int):
         '''
-        Waits for a message with a 2 second timeout
+        Logs a reading, the oldest one is dropped when the buffer is full
         '''
-        packets = self.lora.receive(timeout=self.__PACKET_WAIT)
-        if packets:
-            logging.debug(f'Got packets: {packets}')
-            return packets
-        return False
+        self.readings.append(
+            (self.next_seq, int(time.time()), round(temp*100), int(hmdt)))
+        self.next_seq += 1
+        write_atomically(self.path, {'next_seq': self.next_seq,
+                                     'readings': list(self.readings)})
 
-    def send_message(self, message):
+    def pack(self, since: int = 0):
         '''
-        Sends a message
+        Packs and compresses the readings logged after sequence number since
         '''
-        logging.debug(f'Sending message: {message}')
-        packets = bytes(message, 'utf-8')
-        self.lora.send(packets)
+        return pack_readings(reading for reading in self.readings
+                             if reading[0] > since)
+
+
+class DoseLog:
+    '''
+    Ids of the recently dispensed doses, saved to disk so a repeated
+    pump command is recognised even after a restart
+    '''
+    __PATH = 'dispensed_doses.json'
+    __CAPACITY = 100
+
+    def __init__(self, path: str = __PATH, capacity: int = __CAPACITY):
+        self.path = path
+        self.doses = deque(maxlen=capacity)
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as log_file:
+                    doses = [str(dose_id) for dose_id in json.load(log_file)]
+            except (ValueError, TypeError) as e:
+                logging.warning(f'Discarding unreadable dose log: {e}')
+            else:
+                self.doses.extend(doses)
+
+    def __contains__(self, dose_id: str):
+        return dose_id in self.doses
+
+    def add(self, dose_id: str):
+        self.doses.append(dose_id)
+        write_atomically(self.path, list(self.doses))
 
 
 class WateringPump:
     '''
     This class is responsible for running the water pump
     '''
-    __PINS = {'pwm': board.D20}
+    __PINS = {'pwm': 'D20'}
     __FLOW_RATE = 130
 
     def __init__(self):
         '''
         Initializes the DigitalIO pin controlling the pump
         '''
-        self.ctrl_pin = self.__PINS['pwm']
+        import board
+        import digitalio
+
+        self.ctrl_pin = getattr(board, self.__PINS['pwm'])
         self.pump = digitalio.DigitalInOut(self.ctrl_pin)
         self.pump.direction = digitalio.Direction.OUTPUT
         self.pump.value = False
@@ -109,15 +146,20 @@ class SoliSensor:
     This class controls the i2c soul and humidity sensor
     '''
     __PINS = {
-        'sda': board.SDA,
-        'scl': board.SCL
+        'sda': 'SDA',
+        'scl': 'SCL'
     }
 
     def __init__(self):
         '''
         Initializes the i2c channel and the python Seesaw API
         '''
-        i2c = busio.I2C(self.__PINS['scl'], self.__PINS['sda'])
+        import board
+        import busio
+        from adafruit_seesaw.seesaw import Seesaw
+
+        i2c = busio.I2C(getattr(board, self.__PINS['scl']),
+                        getattr(board, self.__PINS['sda']))
         self.sensor = Seesaw(i2c, addr=0x36)
         logging.debug(
             f'Init\'d soil sensor, humidity: {self.sensor.moisture_read()}, '
@@ -154,6 +196,9 @@ class SensorNode:
     measured data
     '''
 
+    __LOG_INTERVAL = 60*60  # Seconds between buffered readings
+    __FRAGMENT_GAP = 0.05  # Lets the master read each packet out
+
     def __init__(self):
         '''
         Initializes the LoRa class and the sensors and pump
@@ -161,6 +206,26 @@ class SensorNode:
         self.com = LoRa()
         self.probe = SoliSensor()
         self.pump = WateringPump()
+        self.buffer = ReadingBuffer()
+        self.doses = DoseLog()
+        self.last_logged = 0
+        self.transfer = []  # Fragments of the current bulk transfer
+        self.dispatcher = CommandDispatcher()
+        self.dispatcher.register('ping', self.ping)
+        self.dispatcher.register('iot_g_temp', self.get_soil_temp)
+        self.dispatcher.register('iot_g_hmdt', self.get_soil_hmdt)
+        self.dispatcher.register('iot_pmp_ctrl', self.pump_control)
+        self.dispatcher.register('iot_g_log', self.get_log)
+        self.dispatcher.register('iot_g_frag', self.get_fragments)
+
+    def log_reading(self):
+        '''
+        Buffers a reading every log interval
+        '''
+        if time.time() - self.last_logged < self.__LOG_INTERVAL:
+            return
+        self.last_logged = time.time()
+        self.buffer.append(self.probe.get_temp(), self.probe.get_hmdt())
 
     def wait_for_instructions(self):
         '''
@@ -171,24 +236,11 @@ class SensorNode:
             iot_g_temp: get sensor temperature
             iot_g_hmdt: get sendor humidity
             iot_pmp_ctrl: run the pump
+            iot_g_log: start a bulk transfer of the buffered readings
+            iot_g_frag: send fragments of the bulk transfer
         '''
-        self.__instrucitons = {
-            'ping': self.ping,
-            'iot_g_temp': self.get_soil_temp,
-            'iot_g_hmdt': self.get_soil_hmdt,
-            'iot_pmp_ctrl': self.pump_control
-        }
-        while True:  # Do this forever
-            command = self.com.receive_message()
-            if command:
-                command = command.decode()
-                logging.debug(f'Decoded command: {command}')
-                commands = str(command).split('|')
-                logging.debug(f'Processed commands: {commands}')
-                try:
-                    self.__instrucitons[commands[0]](commands[1])
-                except Exception as e:
-                    logging.error(f'Exception: {e}')
+        # Do this forever
+        self.dispatcher.serve(self.com.receive_message, idle=self.log_reading)
 
     def ping(self, *_):
         time.sleep(0.5)
@@ -206,10 +258,49 @@ class SensorNode:
         time.sleep(0.5)
         self.com.send_message(str(soil_hmdt))
 
-    def pump_control(self, volume):
+    def get_log(self, since):
+        '''
+        Prepares the readings logged after since for transfer
+        and replies with the fragment count and checksum
+        '''
+        payload = self.buffer.pack(int(since or 0))
+        self.transfer = fragment(payload)
+        time.sleep(0.5)
+        self.com.send_message(
+            f'LOG|{len(self.transfer)}|{zlib.crc32(payload)}')
+
+    def get_fragments(self, indexes):
+        '''
+        Sends the requested fragments back to back, all of them if
+        no indexes are given, each prefixed with its index
+        '''
+        if indexes:
+            wanted = [int(index) for index in indexes.split(',')]
+        else:
+            wanted = range(len(self.transfer))
+        time.sleep(0.5)
+        for index in wanted:
+            if index < len(self.transfer):
+                self.com.send_bytes(
+                    pack_fragment(index, self.transfer[index]))
+                time.sleep(self.__FRAGMENT_GAP)
+
+    def pump_control(self, argument):
+        '''
+        Runs the pump, the argument is "<volume>,<dose id>". The OK is sent
+        before dispensing, so if it is lost the command is resent with the
+        same id and only confirmed again. Commands without an id always run
+        '''
+        volume, _, dose_id = argument.partition(',')
         water_qty = int(volume)
-        logging.info(f'Dispensing {water_qty} ml.')
         time.sleep(0.5)
+        if dose_id and dose_id in self.doses:
+            logging.info(f'Dose {dose_id} was already dispensed')
+            self.com.send_message('OK')
+            return
+        if dose_id:
+            self.doses.add(dose_id)
+        logging.info(f'Dispensing {water_qty} ml.')
         self.com.send_message('OK')
         self.pump.dispense(water_qty)
 
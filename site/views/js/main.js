@@ -1,36 +1,21 @@
-var timestamps = []
-var temperatures = []
-var humidities = []
-var winds = []
-var precipitations = []
-var clouds = []
-var stemps = []
-var shmdts = []
-var datetimes = []
-var formatted_datetimes = []
-var test_1 = [1, 2, 3, 4, 5, 6, 7]
-var test_2 = [1, 2, 3, 4, 5, 6, 7]
-    // let data_lim = 2
-let data_lim = 240
+var series = {}
+var series_fields = ["temp", "humidity", "wind", "rain_1h", "cloud", "local_soil_temperature", "local_soil_humidity"]
+    // let data_points = 2
+let data_points = 240
 
 async function get_all_data() {
-    let database = firebase.firestore()
-    let weather_data = database.collection("weather_data")
+    // The predictor serves downsampled columns, repeat views revalidate with the ETag
+    let url = "https://api.maxhunt.design/series?fields=" + series_fields.join(",") + "&points=" + data_points
     console.log("Waiting for data...");
-    var data_snapshot = await weather_data.orderBy("timestamp", "desc").limit(data_lim).get()
+    var rsp = await fetch(url, { cache: "no-cache" })
+    var parsed = await rsp.json()
     console.log("Got data, Processing...");
-    data_snapshot.forEach((data_slice) => {
-        var slice = data_slice.data()
-        timestamps.push(slice.timestamp)
-        datetimes.push(slice.datetime)
-        formatted_datetimes.push(slice.datetime.toDate())
-        temperatures.push(slice.temp)
-        humidities.push(slice.humidity)
-        winds.push(slice.wind)
-        precipitations.push(slice.rain_1h)
-        clouds.push(slice.cloud)
-        stemps.push(slice.local_soil_temperature)
-        shmdts.push(slice.local_soil_humidity)
+    series_fields.forEach((field) => {
+        var column = parsed.value.series[field]
+        series[field] = {
+            x: column.timestamp.map((timestamp) => new Date(timestamp * 1000)),
+            y: column.value
+        }
     })
     console.log("Added all data...");
 }
@@ -38,8 +23,8 @@ async function get_all_data() {
 function draw_graph(ySeries, names, colors, div_name) {
     var trace = {
         type: ySeries.type,
-        y: ySeries.data,
-        x: formatted_datetimes,
+        y: ySeries.data.y,
+        x: ySeries.data.x,
         text: names.title,
         line: { shape: 'spline' },
         // marker: { color: colors.trace, line: { width: 3 } }
@@ -65,33 +50,33 @@ function draw_graph(ySeries, names, colors, div_name) {
 async function plot_graphs() {
     await get_all_data()
     console.log("Starting data plot...");
-    draw_graph({ data: temperatures, type: 'line' }, { title: "Air Temperature", yaxis: "Temperature in ºC" }, { trace: '#00FFFF' },
+    draw_graph({ data: series.temp, type: 'line' }, { title: "Air Temperature", yaxis: "Temperature in ºC" }, { trace: '#00FFFF' },
         'temp_chart'
     )
-    draw_graph({ data: humidities, type: 'line' }, { title: "Humidity", yaxis: "Air humidity in %" }, { trace: '#00AAFF' },
+    draw_graph({ data: series.humidity, type: 'line' }, { title: "Humidity", yaxis: "Air humidity in %" }, { trace: '#00AAFF' },
         'humidity_chart'
     )
-    draw_graph({ data: winds, type: 'line' }, { title: "Wind speed", yaxis: "Wind speed in m/s" }, { trace: '#AAFFAA' },
+    draw_graph({ data: series.wind, type: 'line' }, { title: "Wind speed", yaxis: "Wind speed in m/s" }, { trace: '#AAFFAA' },
         'wind_chart'
     )
-    draw_graph({ data: precipitations, type: 'bar' }, { title: "Precipitation", yaxis: "Rainfall in mm" }, { trace: '#FF3333' },
+    draw_graph({ data: series.rain_1h, type: 'bar' }, { title: "Precipitation", yaxis: "Rainfall in mm" }, { trace: '#FF3333' },
         'rain_chart'
     )
-    draw_graph({ data: clouds, type: 'bar' }, { title: "Cloud cover", yaxis: "Cloud coverage in %" }, { trace: '#FFFFFF' },
+    draw_graph({ data: series.cloud, type: 'bar' }, { title: "Cloud cover", yaxis: "Cloud coverage in %" }, { trace: '#FFFFFF' },
         'cloud_chart'
     )
-    draw_graph({ data: stemps, type: 'line' }, { title: "Soil temperature", yaxis: "Temperature in ºC" }, { trace: '#FF9966' },
+    draw_graph({ data: series.local_soil_temperature, type: 'line' }, { title: "Soil temperature", yaxis: "Temperature in ºC" }, { trace: '#FF9966' },
         'soil_temp__chart'
     )
-    draw_graph({ data: shmdts, type: 'line' }, { title: "Soil humidity", yaxis: "Humidity (0->3000)" }, { trace: '#9933FF' },
+    draw_graph({ data: series.local_soil_humidity, type: 'line' }, { title: "Soil humidity", yaxis: "Humidity (0->3000)" }, { trace: '#9933FF' },
         'soil_hmdt_chart'
     )
 }
 
 
 function createGraph_2() {
-    console.log(temperatures);
-    var data = [{ type: "line", x: formatted_datetimes, y: temperatures }]
+    console.log(series.temp);
+    var data = [{ type: "line", x: series.temp.x, y: series.temp.y }]
     var layout = { title: 'Graph 2', font: { size: 18 } }
     var config = { responsive: true }
     Plotly.newPlot('chart_2', data, layout, config)
@@ -0,0 +1,10 @@
+from setuptools import setup
+
+setup(
+    name='stats_core',
+    version='1.0.0',
+    description='Mergeable streaming statistics shared by the '
+                'IoT-ICL DE data collector and predictor',
+    packages=['stats_core'],
+    python_requires='>=3.7'
+)
@@ -0,0 +1,7 @@
+'''
+Shared core of the cloud services: the streaming statistics the
+collector maintains and the predictor normalizes with
+'''
+from .running_stats import RunningStats
+
+__all__ = ['RunningStats']
@@ -0,0 +1,68 @@
+'''
+Streaming statistics that can be stored in a document and merged
+'''
+
+
+class RunningStats:
+    '''
+    Streaming mean and variance of a single column using Welford's method.
+    Partial states from different sites or shards can be combined with merge()
+    '''
+
+    def __init__(self, count: int = 0, mean: float = 0.0, m2: float = 0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2  # Sum of squared deviations from the mean
+
+    def update(self, value: float):
+        '''
+        Folds a single new value into the statistics
+        '''
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def remove(self, value: float):
+        '''
+        Takes a value folded in earlier back out, used when
+        a stored reading is corrected
+        '''
+        if self.count <= 1:
+            self.count, self.mean, self.m2 = 0, 0.0, 0.0
+            return
+        self.count -= 1
+        delta = value - self.mean
+        self.mean -= delta / self.count
+        self.m2 = max(0.0, self.m2 - delta * (value - self.mean))
+
+    def merge(self, other):
+        '''
+        Combines two partial states into a new one (Chan et al.)
+        '''
+        count = self.count + other.count
+        if count == 0:
+            return RunningStats()
+        delta = other.mean - self.mean
+        mean = self.mean + delta * other.count / count
+        m2 = (self.m2 + other.m2
+              + delta ** 2 * self.count * other.count / count)
+        return RunningStats(count, mean, m2)
+
+    @property
+    def std(self):
+        '''
+        Sample standard deviation, matches pandas' default
+        '''
+        if self.count < 2:
+            return 0.0
+        return (self.m2 / (self.count - 1)) ** 0.5
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2}
+
+    @classmethod
+    def from_dict(cls, state: dict):
+        return cls(state.get('count', 0),
+                   state.get('mean', 0.0),
+                   state.get('m2', 0.0))